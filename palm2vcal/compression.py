@@ -0,0 +1,293 @@
+# coding: utf-8
+
+"""Transparent gzip, bzip2 and xz streams.
+
+Compressed input is detected from its first bytes and decompressed on the
+fly, reading the underlying file in large chunks; this works on pipes
+as well as on regular files. Compressed output is chosen from the file
+name extension, or explicitly.
+
+xz support requires the lzma module (backports.lzma on Python 2).
+"""
+
+import bz2
+import tempfile
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# Size of the reads on underlying files
+CHUNK_SIZE = 256 * 1024
+
+MAGIC = (
+    ('gz', '\x1f\x8b'),
+    ('bz2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+)
+
+CODECS = tuple(codec for codec, magic in MAGIC)
+
+# Enough bytes to recognize any of the MAGIC prefixes
+PEEK_SIZE = 6
+
+
+def detect(data):
+    """Find the codec of a stream from its first bytes, None if plain."""
+    for codec, magic in MAGIC:
+        if data.startswith(magic):
+            return codec
+    return None
+
+
+def codec_from_name(name):
+    """Find the codec matching a file name extension, None if plain."""
+    for codec in CODECS:
+        if name.endswith('.' + codec):
+            return codec
+    return None
+
+
+def _check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError("Unknown compression %r" % codec)
+    if codec == 'xz' and lzma is None:
+        raise ValueError("xz streams require the lzma module (backports.lzma on Python 2)")
+
+
+# Raised by decompressors on corrupt data
+DECOMPRESSION_ERRORS = (zlib.error, IOError, EOFError)
+if lzma is not None:
+    DECOMPRESSION_ERRORS += (lzma.LZMAError,)
+
+
+def _decompressor(codec):
+    _check_codec(codec)
+    if codec == 'gz':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    else:
+        return lzma.LZMADecompressor()
+
+
+def _compressor(codec):
+    _check_codec(codec)
+    if codec == 'gz':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif codec == 'bz2':
+        return bz2.BZ2Compressor()
+    else:
+        return lzma.LZMACompressor()
+
+
+class DecompressedFile(object):
+    """Read-only file object decompressing a stream on the fly.
+
+    Seeking forward decompresses and drops data; seeking backward
+    restarts from the beginning of the stream, which requires a seekable
+    underlying file, unless the target is still buffered. Readers seeking
+    back and forth should use a copy made by spool() instead.
+
+    Corrupt compressed data raises palmFile.PalmFileError, located at
+    the offset of the decompressed data it would have held.
+
+    Attributes:
+        file_obj: file object, the underlying compressed stream
+        codec: str, one of CODECS, or None for a plain stream
+        name: str, name of the underlying file, if any
+    """
+
+    def __init__(self, file_obj, codec, prefix=''):
+        self.file_obj = file_obj
+        self.codec = codec
+        self.name = getattr(file_obj, 'name', None)
+        if codec is not None:
+            _check_codec(codec)
+        try:
+            self._origin = file_obj.tell() - len(prefix)
+        except (AttributeError, IOError):
+            self._origin = None
+        self._reset(prefix)
+
+    def _reset(self, prefix=''):
+        self._decompressor = None if self.codec is None else _decompressor(self.codec)
+        self._raw = prefix
+        # self._buffer[self._offset:] has not been read yet, and
+        # self._position bytes of the stream come before self._buffer
+        self._buffer = ''
+        self._offset = 0
+        self._position = 0
+
+    def _fill(self):
+        """Append decompressed data to the buffer; False at end of stream."""
+        while True:
+            raw, self._raw = self._raw, ''
+            if not raw:
+                raw = self.file_obj.read(CHUNK_SIZE)
+                if not raw:
+                    return False
+            if self._decompressor is None:
+                data = raw
+            else:
+                try:
+                    data = self._decompressor.decompress(raw)
+                except DECOMPRESSION_ERRORS, e:
+                    # palmFile imports this module
+                    from palm2vcal import palmFile
+                    raise palmFile.PalmFileError("Corrupt %s stream: %s" % (self.codec, e),
+                        self._position + len(self._buffer))
+                if self._decompressor.unused_data:
+                    # Concatenated streams, as produced by 'cat a.gz b.gz'
+                    self._raw = self._decompressor.unused_data
+                    self._decompressor = _decompressor(self.codec)
+            if data:
+                self._position += self._offset
+                self._buffer = self._buffer[self._offset:] + data
+                self._offset = 0
+                return True
+
+    def read(self, size=-1):
+        if size < 0:
+            while self._fill():
+                pass
+            size = len(self._buffer) - self._offset
+        else:
+            while len(self._buffer) - self._offset < size and self._fill():
+                pass
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def tell(self):
+        return self._position + self._offset
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+        elif whence != 0:
+            raise IOError("Cannot seek from the end of a compressed stream")
+
+        if offset < self._position:
+            if self._origin is None:
+                raise IOError("Cannot seek backwards in a compressed stream")
+            self.file_obj.seek(self._origin)
+            self._reset()
+        while offset > self._position + len(self._buffer):
+            self._offset = len(self._buffer)
+            if not self._fill():
+                break
+        self._offset = min(offset - self._position, len(self._buffer))
+
+    def close(self):
+        self.file_obj.close()
+
+
+class CompressedFile(object):
+    """Write-only file object compressing data on the fly.
+
+    Attributes:
+        file_obj: file object, where compressed data is written
+        codec: str, one of CODECS
+        close_file: bool, whether close() also closes file_obj
+    """
+
+    def __init__(self, file_obj, codec, close_file=True):
+        self.file_obj = file_obj
+        self.codec = codec
+        self.close_file = close_file
+        self._compressor = _compressor(codec)
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self.file_obj.write(data)
+
+    def close(self):
+        """Terminate the compressed stream."""
+        if self._compressor is None:
+            return
+        self.file_obj.write(self._compressor.flush())
+        self._compressor = None
+        if self.close_file:
+            self.file_obj.close()
+        else:
+            self.file_obj.flush()
+
+
+def is_compressed(file_obj):
+    """Whether a file object returned by open_input decompresses data."""
+    return isinstance(file_obj, DecompressedFile) and file_obj.codec is not None
+
+
+def spool(file_obj, max_size=CHUNK_SIZE):
+    """Copy a file object, from its start, to a temporary file.
+
+    Seeking in the copy is cheap, unlike in a DecompressedFile. Copies
+    of up to max_size bytes are kept in memory.
+
+    Returns:
+        tempfile.SpooledTemporaryFile, positioned at its start
+    """
+    copy = tempfile.SpooledTemporaryFile(max_size=max_size)
+    file_obj.seek(0)
+    copy_data(file_obj, copy)
+    copy.seek(0)
+    return copy
+
+
+def copy_data(src_file, dst_file):
+    """Copy what is left of src_file to dst_file, in chunks."""
+    while True:
+        data = src_file.read(CHUNK_SIZE)
+        if not data:
+            break
+        dst_file.write(data)
+
+
+def open_input(file_obj):
+    """Wrap a file object open for reading if it holds compressed data.
+
+    Non-seekable plain streams are wrapped as well, so that the bytes
+    peeked at are not lost.
+    """
+    data = file_obj.read(PEEK_SIZE)
+    codec = detect(data)
+    if codec is None:
+        try:
+            file_obj.seek(-len(data), 1)
+            return file_obj
+        except (AttributeError, IOError):
+            pass
+    return DecompressedFile(file_obj, codec, prefix=data)
+
+
+def open_file(name, mode='rb', codec=None):
+    """Open a file, compressed or not.
+
+    Args:
+        name: str, the file name
+        mode: 'rb' or 'wb'
+        codec: str, the compression of written files; defaults to the
+            one matching the extension of name. Read files are always
+            detected from their contents.
+    """
+    if mode == 'rb':
+        return open_input(open(name, 'rb'))
+    elif mode == 'wb':
+        if codec is None:
+            codec = codec_from_name(name)
+        if codec is not None:
+            _check_codec(codec)
+        dst_file = open(name, 'wb')
+        if codec is None:
+            return dst_file
+        return CompressedFile(dst_file, codec)
+    else:
+        raise ValueError("Unsupported mode %r" % mode)
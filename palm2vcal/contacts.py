@@ -0,0 +1,224 @@
+# coding: utf-8
+
+import bisect
+import json
+import os
+import re
+import unicodedata
+
+import palmFile
+
+from palm2vcal import compression
+from palm2vcal import converter
+
+
+# Bumped whenever the layout of saved indexes changes
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.palm2vcal-index.json'
+
+NAME_FIELDS = ('lastName', 'firstName', 'companyName')
+PHONE_FIELDS = ('phone1Text', 'phone2Text', 'phone3Text', 'phone4Text', 'phone5Text')
+
+
+def normalize_name(text):
+    """Search key of a name: lower case words, without accents."""
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return u' '.join(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+def normalize_phone(text):
+    """Search key of a phone number: its digits."""
+    return re.sub(r'\D', '', text, flags=re.UNICODE)
+
+
+def name_keys(contact):
+    """Name keys of a contact, as decoded by Palm2vCalConverter.map_json.
+
+    Every field is indexed from each of its words, so that 'widg' finds
+    'ACME Widgets'; full names are indexed both ways.
+    """
+    keys = set()
+    for field in NAME_FIELDS:
+        words = normalize_name(contact.get(field) or u'').split()
+        for start in xrange(len(words)):
+            keys.add(u' '.join(words[start:]))
+    first = normalize_name(contact.get('firstName') or u'')
+    last = normalize_name(contact.get('lastName') or u'')
+    if first and last:
+        keys.add(u'%s %s' % (first, last))
+        keys.add(u'%s %s' % (last, first))
+    return keys
+
+
+def index_path(path):
+    """Name of the saved index of an address book."""
+    return path + INDEX_SUFFIX
+
+
+def source_stat(path):
+    """Version of an address book saved indexes are checked against."""
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+
+class AddressIndex(object):
+    """Look up the contacts of an address book by name or phone prefix.
+
+    Names (last name, first name and company) and phone numbers are
+    normalised (see normalize_name and normalize_phone) into two sorted
+    key lists, searched by bisection: a lookup costs O(log n) plus the
+    number of matches.
+
+    Indexes are saved next to their address book, and reused by other
+    processes for as long as the address book keeps its size and mtime.
+
+    Attributes:
+        contacts: list of contacts, as decoded by
+            Palm2vCalConverter.map_json, without their empty fields
+        name_keys: sorted list of normalised names
+        name_contacts: list of the positions in contacts of name_keys
+        phone_keys: sorted list of phone number digits
+        phone_contacts: list of the positions in contacts of phone_keys
+    """
+
+    def __init__(self, contacts):
+        self.contacts = contacts
+
+        names = set()
+        phones = set()
+        for position, contact in enumerate(contacts):
+            for key in name_keys(contact):
+                names.add((key, position))
+            for field in PHONE_FIELDS:
+                digits = normalize_phone(contact.get(field) or u'')
+                if digits:
+                    phones.add((digits, position))
+        names = sorted(names)
+        phones = sorted(phones)
+        self.name_keys = [key for key, position in names]
+        self.name_contacts = [position for key, position in names]
+        self.phone_keys = [key for key, position in phones]
+        self.phone_contacts = [position for key, position in phones]
+
+    @classmethod
+    def from_file(cls, path, src_encoding='cp1252'):
+        """Build the index of an address book file."""
+        src_file = compression.open_file(path, 'rb')
+        try:
+            conv = converter.Palm2vCalConverter(src_file, src_encoding=src_encoding)
+            header, records = palmFile.iterPalmFileObject(src_file)
+            if header['versionTag'] != converter.ADDRESS_BOOK_TAG:
+                raise ValueError("%r is not an address book" % path)
+            conv.load_header(header)
+            # Empty fields are left out, keeping saved indexes small
+            return cls([dict((label, value) for label, value in conv.map_json(e).items()
+                if value not in (u'', None)) for e in records])
+        finally:
+            src_file.close()
+
+    @classmethod
+    def for_file(cls, path, src_encoding='cp1252'):
+        """Load the saved index of an address book, building it if needed.
+
+        An index saved for another version of the file, or another
+        encoding, is built and saved again.
+        """
+        stat = source_stat(path)
+        try:
+            index_file = open(index_path(path), 'rb')
+        except IOError:
+            saved = None
+        else:
+            try:
+                saved = json.load(index_file)
+            except ValueError:
+                saved = None
+            finally:
+                index_file.close()
+
+        if (saved is not None and saved.get('version') == INDEX_VERSION
+                and saved.get('source') == list(stat)
+                and saved.get('encoding') == src_encoding):
+            return cls.from_dict(saved)
+
+        index = cls.from_file(path, src_encoding)
+        try:
+            index.save(index_path(path), stat, src_encoding)
+        except (IOError, OSError):
+            # Read-only location: the index is still usable, just not kept
+            pass
+        return index
+
+    @classmethod
+    def from_dict(cls, saved):
+        """Rebuild an index from what save() wrote, without sorting again."""
+        index = cls.__new__(cls)
+        index.contacts = saved['contacts']
+        index.name_keys = saved['name_keys']
+        index.name_contacts = saved['name_contacts']
+        index.phone_keys = saved['phone_keys']
+        index.phone_contacts = saved['phone_contacts']
+        return index
+
+    def save(self, path, stat, src_encoding):
+        """Write the index to path, through a temporary file.
+
+        Args:
+            path: str, name of the index file
+            stat: (size, mtime) tuple of the address book, see source_stat
+            src_encoding: the encoding the address book was read with
+        """
+        index_file = open(path + '.tmp', 'wb')
+        try:
+            json.dump({
+                'version': INDEX_VERSION,
+                'source': list(stat),
+                'encoding': src_encoding,
+                'contacts': self.contacts,
+                'name_keys': self.name_keys,
+                'name_contacts': self.name_contacts,
+                'phone_keys': self.phone_keys,
+                'phone_contacts': self.phone_contacts,
+            }, index_file)
+        finally:
+            index_file.close()
+        os.rename(path + '.tmp', path)
+
+    def _prefix(self, keys, positions, prefix, limit):
+        found = []
+        seen = set()
+        for i in xrange(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            if positions[i] not in seen:
+                seen.add(positions[i])
+                found.append(self.contacts[positions[i]])
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def by_name(self, prefix, limit=None):
+        """Contacts with a name starting with prefix, by matching name.
+
+        Args:
+            prefix: unicode, compared without case nor accents
+            limit: int, maximum number of contacts returned, if any
+        """
+        prefix = normalize_name(prefix)
+        if not prefix:
+            return []
+        return self._prefix(self.name_keys, self.name_contacts, prefix, limit)
+
+    def by_phone(self, prefix, limit=None):
+        """Contacts with a phone number starting with the digits of prefix."""
+        prefix = normalize_phone(prefix)
+        if not prefix:
+            return []
+        return self._prefix(self.phone_keys, self.phone_contacts, prefix, limit)
+
+    def search(self, query, limit=None):
+        """Look a query up as a phone number if it has no letters, else as a name."""
+        if re.search(r'[^\W\d_]', query, re.UNICODE):
+            return self.by_name(query, limit)
+        return self.by_phone(query, limit)
@@ -1,23 +1,164 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import codecs
 import datetime
+import hashlib
+import json
 
 import icalendar
 import palmFile
 
 from palm2vcal import __version__
+from palm2vcal import compression
+from palm2vcal import sync
+
+
+ADDRESS_BOOK_TAG = "\x00\x01BA"
+
+# Decoding functions, by encoding name; shared by all converters
+_decoders = {}
+
+
+def get_decoder(encoding):
+    """Find the decoding function of an encoding, looking it up only once.
+
+    Raises:
+        LookupError: the encoding is unknown
+    """
+    decoder = _decoders.get(encoding)
+    if decoder is None:
+        decoder = _decoders.setdefault(encoding, codecs.getdecoder(encoding))
+    return decoder
+
+
+class IcsBackend(object):
+    """Write datebook records as an iCalendar VCALENDAR.
+
+    Attributes:
+        converter: the Palm2vCalConverter mapping records to events
+        method: str, optional iTIP METHOD of the calendar
+    """
+
+    FOOTER = 'END:VCALENDAR\r\n'
+
+    def __init__(self, converter, method=None):
+        self.converter = converter
+        self.method = method
+
+    def start(self, dst_file, header=None):
+        """Write the beginning of the output, given the palmFile header."""
+        if header is not None and header['versionTag'] == ADDRESS_BOOK_TAG:
+            raise ValueError("Address books cannot be written as iCalendar")
+        vcal = icalendar.Calendar()
+        vcal.add('prodid', "Xelnext palm2vCal converter")
+        vcal.add('version', __version__)
+        if self.method:
+            vcal.add('method', self.method)
+
+        text = vcal.to_ical()
+        assert text.endswith(self.FOOTER)
+        dst_file.write(text[:-len(self.FOOTER)])
+
+    def write(self, dst_file, e, uid=None):
+        """Write a palmFile record, see map()."""
+        self.write_component(dst_file, self.map(e, uid))
+
+    def map(self, e, uid=None):
+        """Map a palmFile record to what serialize() takes.
+
+        Args:
+            e: dict, the palmFile record
+            uid: str, the UID of the record, if already built by make_uid
+        """
+        return self.converter.map_event(e, uid=uid)
+
+    def serialize(self, component):
+        return component.to_ical()
+
+    def write_component(self, dst_file, component):
+        """Write an already mapped icalendar component."""
+        dst_file.write(self.serialize(component))
+
+    def finish(self, dst_file):
+        """Write the end of the output."""
+        dst_file.write(self.FOOTER)
+
+
+class JsonLinesBackend(object):
+    """Write records as JSON Lines, one object per event or contact.
+
+    Objects are built straight from palmFile records, without going
+    through icalendar; see Palm2vCalConverter.map_json.
+
+    Attributes:
+        converter: the Palm2vCalConverter decoding records
+    """
+
+    def __init__(self, converter):
+        self.converter = converter
+
+    def start(self, dst_file, header=None):
+        pass
+
+    def write(self, dst_file, e, uid=None):
+        dst_file.write(self.serialize(self.map(e, uid)))
+
+    def map(self, e, uid=None):
+        return self.converter.map_json(e, uid)
+
+    def serialize(self, record):
+        return json.dumps(record, sort_keys=True) + '\n'
+
+    def finish(self, dst_file):
+        pass
+
+
+# Output backends, by format name
+BACKENDS = {
+    'ics': IcsBackend,
+    'jsonl': JsonLinesBackend,
+}
+
 
 class Palm2vCalConverter(object):
     """Convert a .dba file into a .ics dict.
 
+    In streaming mode, export() reads, maps and writes events one at a
+    time: neither raw records nor events are retained, so memory use does
+    not depend on the size of the source file. import_file() is not
+    available in that mode, and events and raw_data stay empty.
+
+    Output goes through a backend chosen by output_format among BACKENDS;
+    other formats than 'ics' also accept address books.
+
+    Records can be selected by time, category and repetition. These
+    filters are evaluated by palmFile on the fixed-width fields of each
+    record, before its strings and repeat rule are decoded: rejected
+    records cost a structural walk, and never reach map_event().
+    A repeating event is kept when it starts before until and its repeat
+    rule ends after since, a single event when it starts before until and
+    ends after since.
+
     Attributes:
         src_file: file object, source file to read from
         src_encoding: the encoding to use when reading text from the source
             file
+        streaming: bool, whether to convert in constant memory
+        output_format: str, name of the output backend in BACKENDS
+        since: int, if set, timestamp before which events are left out
+        until: int, if set, timestamp from which events are left out
+        filter_categories: set of the (unicode) names of the categories
+            to convert, None for all of them
+        only_repeating: bool, whether to leave single events out
+        uid_namespace: str, identity of the source file in event UIDs;
+            defaults to the file name stored in its header
+        sync_state: sync.SyncState, if set, gives events a SEQUENCE and
+            LAST-MODIFIED following changes of their contents
         categories: dict mapping a category index to its (long) name
         events: list of icalendar.vEvent
         raw_data: raw data returned by palmFile.
+        num_events: int, number of events (or contacts) converted so far
     """
 
     DAYMASK_TRANSLATION = {
@@ -30,6 +171,9 @@ class Palm2vCalConverter(object):
         64: 'SA',
     }
 
+    # Fields that do not hold event content
+    IGNORED_FIELDS = ('recordID', 'status', 'position')
+
     DAY_NAMES = {
         0: 'MO',
         1: 'TU',
@@ -40,33 +184,147 @@ class Palm2vCalConverter(object):
         6: 'SU',
     }
 
-    def __init__(self, src_file, src_encoding='cp1252'):
+    def __init__(self, src_file, src_encoding='cp1252', streaming=False,
+            uid_namespace=None, sync_state=None, output_format='ics',
+            since=None, until=None, categories=None, only_repeating=False):
+        if output_format not in BACKENDS:
+            raise ValueError("Unknown output format %r" % output_format)
         self.src_file = src_file
         self.src_encoding = src_encoding
+        self._decode = get_decoder(src_encoding)
+        self.streaming = streaming
+        self.output_format = output_format
+        self.uid_namespace = uid_namespace
+        self.sync_state = sync_state
+        self.since = since
+        self.until = until
+        self.filter_categories = None
+        if categories is not None:
+            self.filter_categories = set(
+                unicode(name, 'utf-8') if isinstance(name, str) else name
+                for name in categories)
+        self.only_repeating = only_repeating
+        self._filter_indexes = None
+        self._uid_suffix = None
+        self._anonymous_digest = None
+        self._anonymous_rank = 0
         self.categories = {}
         self.events = []
         self.raw_data = None
+        self.num_events = 0
 
     def export(self, dst_file):
         """Export events to a file object."""
-        if not self.events:
-            self.import_file()
-        vcal = icalendar.Calendar()
-        vcal.add('prodid', "Xelnext palm2vCal converter")
-        vcal.add('version', __version__)
+        if not self.streaming and self.output_format == 'ics':
+            if self.raw_data is None:
+                self.import_file()
+            self.write_calendar(dst_file, self.events)
+            return
+
+        if self.streaming:
+            header, records = palmFile.iterPalmFileObject(self.src_file, self.record_filter)
+            self.load_header(header)
+        else:
+            if self.raw_data is None:
+                self.raw_data = palmFile.readPalmFileObject(self.src_file, self.record_filter)[0]
+                self.load_header(self.raw_data)
+            header = self.raw_data
+            if header['versionTag'] == ADDRESS_BOOK_TAG:
+                records = header['addresses']
+            else:
+                records = header['datebookList']
+            self.num_events = 0
+
+        backend = BACKENDS[self.output_format](self)
+        backend.start(dst_file, header)
+        for e in records:
+            if not self.accept_record(e):
+                continue
+            self.num_events += 1
+            backend.write(dst_file, e)
+        backend.finish(dst_file)
+
+    def iter_events(self):
+        """Read and convert events from the source file, one at a time."""
+        header, records = palmFile.iterPalmFileObject(self.src_file, self.record_filter)
+        self.load_header(header)
+        for e in records:
+            if not self.accept_record(e):
+                continue
+            self.num_events += 1
+            yield self.map_event(e)
+
+    @property
+    def record_filter(self):
+        """Predicate given to palmFile, None when no filter is set."""
+        if (self.since is None and self.until is None
+                and self.filter_categories is None and not self.only_repeating):
+            return None
+        return self.accept_fields
+
+    def accept_fields(self, fields, header):
+        """Select a record from its fixed-width fields.
 
-        for e in self.events:
-            vcal.add_component(e)
+        Args:
+            fields: dict, the fields of the record, as yielded by
+                palmFile.scanPalmFileObject
+            header: dict, the header of the source file
+        """
+        if self.filter_categories is not None:
+            if self._filter_indexes is None:
+                self._filter_indexes = set(category['index']
+                    for category in header['categoryList']
+                    if self.clean(category['longName']) in self.filter_categories)
+            if fields['category'] not in self._filter_indexes:
+                return False
+
+        if self.since is None and self.until is None and not self.only_repeating:
+            return True
+        if 'startTime' not in fields:
+            raise ValueError("Only datebook records can be selected by time or repetition")
+        repeating = fields['repeatEvent'] != 0
+        if self.only_repeating and not repeating:
+            return False
+        if self.until is not None and fields['startTime'] >= self.until:
+            return False
+        if self.since is not None and not repeating and fields['endTime'] < self.since:
+            return False
+        return True
+
+    def accept_record(self, e):
+        """Select a decoded record on what accept_fields cannot see.
+
+        The end of repeat rules is only known once they are decoded.
+        """
+        if self.since is None or 'repeatEvent' not in e:
+            return True
+        repeat = e['repeatEvent']
+        return not repeat['repeatEventFlag'] or repeat['endDate'] >= self.since
+
+    def write_calendar(self, dst_file, events, method=None):
+        """Write a VCALENDAR holding events to a file object.
 
-        dst_file.write(vcal.to_ical())
+        Components are serialized and written one at a time, so events
+        may be any iterable, including a generator.
+
+        Args:
+            dst_file: file object, where to write
+            events: iterable of icalendar components
+            method: str, optional iTIP METHOD of the calendar
+        """
+        backend = IcsBackend(self, method)
+        backend.start(dst_file)
+        for e in events:
+            backend.write_component(dst_file, e)
+        backend.finish(dst_file)
 
     def clean(self, value):
         """Clean input data read from the source file.
 
         Currently converts to unicode with adequate encoding.
         """
-        if isinstance(value, basestring):
-            return unicode(value, self.src_encoding)
+        if isinstance(value, str):
+            return self._decode(value)[0]
         else:
             return value
 
@@ -88,17 +346,136 @@ class Palm2vCalConverter(object):
 
     def import_file(self):
         """Perform the actual source file parsing."""
-        self.raw_data = palmFile.readPalmFileObject(self.src_file)[0]
-        for category in self.raw_data['categoryList']:
-            self.categories[category['index']] = self.clean(category['longName'])
+        if self.streaming:
+            raise ValueError("import_file() retains all events, which streaming mode forbids")
+        self.raw_data = palmFile.readPalmFileObject(self.src_file, self.record_filter)[0]
+        self.load_header(self.raw_data)
 
         for e in self.raw_data['datebookList']:
-            self.events.append(self.map_event(e))
+            if self.accept_record(e):
+                self.events.append(self.map_event(e))
+        self.num_events = len(self.events)
+
+    def load_header(self, header):
+        """Load categories and file identity from a palmFile header."""
+        for category in header['categoryList']:
+            self.categories[category['index']] = self.clean(category['longName'])
+        if self.uid_namespace is None:
+            self.uid_namespace = header['fileName'] or 'palm'
+
+    def file_uid_suffix(self, namespace):
+        """Build the part of UIDs identifying a source file."""
+        if isinstance(namespace, unicode):
+            namespace = namespace.encode('utf-8')
+        return '%s@palm2vcal' % hashlib.sha1(namespace).hexdigest()[:12]
+
+    def digest(self, e):
+        """Content hash of a palmFile event."""
+        return palmFile.recordDigest(e, exclude=self.IGNORED_FIELDS)
+
+    def make_uid(self, e, namespace=None):
+        """Build a stable UID for a palmFile event.
+
+        UIDs derive from the recordID and the identity of the source file.
+        Records without an ID fall back on their content hash, numbered
+        when several of them in a row share the same contents. Only the
+        last content hash is remembered, so that UIDs cost constant
+        memory: records without an ID repeating the contents of an
+        earlier, not adjacent, one share its UID, as they describe the
+        same event.
+
+        Args:
+            e: dict, the palmFile event
+            namespace: str, the identity of the source file; defaults to
+                self.uid_namespace
+        """
+        if namespace is None:
+            if self._uid_suffix is None:
+                self._uid_suffix = self.file_uid_suffix(self.uid_namespace or 'palm')
+            suffix = self._uid_suffix
+        else:
+            suffix = self.file_uid_suffix(namespace)
+
+        if e.get('recordID'):
+            return '%d-%s' % (e['recordID'], suffix)
+
+        digest = self.digest(e)
+        if digest == self._anonymous_digest:
+            self._anonymous_rank += 1
+        else:
+            self._anonymous_digest = digest
+            self._anonymous_rank = 0
+        return 'c%s-%d-%s' % (digest[:16], self._anonymous_rank, suffix)
+
+    def record_uid(self, e, record_ids):
+        """Build a UID that no other record of the same file shares.
+
+        Records whose recordID is 0 or already in record_ids get the UID
+        of a record without ID, built from their contents; see make_uid.
 
-    def map_event(self, e):
-        """Convert a palmFile event into an icalendar.Event."""
+        Args:
+            e: dict, the palmFile record
+            record_ids: set of the recordIDs met so far in the file,
+                updated by this method
+        """
+        if e['recordID'] in record_ids:
+            return self.make_uid(dict(e, recordID=0))
+        # make_uid() falls back on the contents for a recordID of 0
+        record_ids.add(e['recordID'])
+        return self.make_uid(e)
+
+    def json_value(self, value):
+        """Make a value read from the source file JSON-friendly."""
+        if isinstance(value, dict):
+            return dict((k, self.json_value(v)) for k, v in value.items())
+        elif isinstance(value, list):
+            return [self.json_value(v) for v in value]
+        elif isinstance(value, str):
+            return self.clean(value)
+        return value
+
+    def map_json(self, e, uid=None):
+        """Convert a palmFile event or contact into a JSON-friendly dict.
+
+        Text is decoded, categories are named and, for events, start and
+        end times use the ISO 8601 format; the repeat rule is kept as is.
+
+        Args:
+            e: dict, the palmFile event or contact
+            uid: str, the UID of the record, if already built by make_uid
+        """
+        record = {}
+        for label, value in e.items():
+            if label == 'category':
+                value = self.categories.get(value)
+            elif label in ('startTime', 'endTime'):
+                value = self.mkdate(value, e['untimed']).isoformat()
+            elif label == 'repeatEvent':
+                value = dict(value)
+                if 'brandDaysMask' in value:
+                    value['brandDaysMask'] = ord(value['brandDaysMask'])
+            record[label] = self.json_value(value)
+        record['type'] = 'event' if 'startTime' in e else 'contact'
+        record['uid'] = uid if uid is not None else self.make_uid(e)
+        return record
+
+    def map_event(self, e, namespace=None, uid=None):
+        """Convert a palmFile event into an icalendar.Event.
+
+        Args:
+            e: dict, the palmFile event
+            namespace: str, the identity of the source file, see make_uid
+            uid: str, the UID of the event, if already built by make_uid
+        """
 
         event = icalendar.Event()
+        if uid is None:
+            uid = self.make_uid(e, namespace)
+        event.add('uid', uid)
+        if self.sync_state is not None:
+            sequence, last_modified = self.sync_state.update(uid, self.digest(e))
+            event.add('sequence', sequence)
+            event.add('last-modified', last_modified)
         event.add('dtstart', self.mkdate(e['startTime'], e['untimed']))
         event.add('dtend', self.mkdate(e['endTime'], e['untimed']))
         event.add('summary', self.clean(e['text']))
@@ -174,3 +551,93 @@ class Palm2vCalConverter(object):
         return event
 
 
+# Options of convert(), with their default values
+DEFAULT_OPTIONS = {
+    'src_encoding': 'cp1252',
+    'output_format': 'ics',
+    'uid_namespace': None,
+    'sync_state': None,
+    'compress': None,
+    'since': None,
+    'until': None,
+    'categories': None,
+    'only_repeating': False,
+}
+
+
+def convert(src, dst, options=None):
+    """Convert a .dba file, in constant memory.
+
+    This function holds no state between calls, and may be called from
+    several threads at once; converters only share the read-only lookup
+    tables of this module. Calls sharing a sync state file must not run
+    concurrently.
+
+    Args:
+        src: str or file object, the source file; compression is detected
+        dst: str or file object, the target file; files opened by name
+            are compressed according to their extension or the 'compress'
+            option
+        options: dict overriding DEFAULT_OPTIONS; 'sync_state' is the
+            path of a sync.SyncState file
+
+    Returns:
+        int, the number of converted events (or contacts)
+    """
+    opts = dict(DEFAULT_OPTIONS)
+    for key, value in (options or {}).items():
+        if key not in DEFAULT_OPTIONS:
+            raise ValueError("Unknown conversion option %r" % key)
+        opts[key] = value
+
+    sync_state = None
+    if opts['sync_state']:
+        sync_state = sync.SyncState(opts['sync_state'])
+        sync_state.load()
+
+    src_file = compression.open_file(src, 'rb') if isinstance(src, basestring) else src
+    try:
+        dst_file = compression.open_file(dst, 'wb', opts['compress']) if isinstance(dst, basestring) else dst
+        try:
+            conv = Palm2vCalConverter(src_file, src_encoding=opts['src_encoding'],
+                streaming=True, uid_namespace=opts['uid_namespace'],
+                sync_state=sync_state, output_format=opts['output_format'],
+                since=opts['since'], until=opts['until'], categories=opts['categories'],
+                only_repeating=opts['only_repeating'])
+            conv.export(dst_file)
+        finally:
+            if dst_file is not dst:
+                dst_file.close()
+    finally:
+        if src_file is not src:
+            src_file.close()
+
+    if sync_state is not None:
+        sync_state.save()
+    return conv.num_events
+
+
+def _convert_job(job):
+    return convert(*job)
+
+
+def convert_many(jobs, executor=None):
+    """Run several conversions, possibly in parallel.
+
+    Conversions spend most of their time waiting for I/O when reading
+    from network mounts, so a thread pool is usually enough: any object
+    with a map() method will do, such as multiprocessing.pool.ThreadPool
+    or concurrent.futures.ThreadPoolExecutor.
+
+    Args:
+        jobs: iterable of (src, dst) or (src, dst, options) tuples, see
+            convert()
+        executor: object running the conversions through its map()
+            method; conversions run one after the other by default
+
+    Returns:
+        list of the numbers of converted events, in the order of jobs
+    """
+    if executor is None:
+        return map(_convert_job, jobs)
+    return list(executor.map(_convert_job, jobs))
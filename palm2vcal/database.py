@@ -0,0 +1,212 @@
+# coding: utf-8
+
+import json
+import os
+import sqlite3
+
+import palmFile
+
+from palm2vcal import compression
+from palm2vcal import converter
+
+
+# Stored as the user_version of databases
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    file_name TEXT,
+    kind TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS categories (
+    source_id INTEGER NOT NULL REFERENCES sources (id),
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (source_id, idx)
+);
+CREATE TABLE IF NOT EXISTS events (
+    source_id INTEGER NOT NULL REFERENCES sources (id),
+    uid TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    untimed INTEGER NOT NULL,
+    repeating INTEGER NOT NULL,
+    category TEXT,
+    text TEXT,
+    note TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (source_id, uid)
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    source_id INTEGER NOT NULL REFERENCES sources (id),
+    uid TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    last_name TEXT,
+    first_name TEXT,
+    company TEXT,
+    category TEXT,
+    note TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (source_id, uid)
+);
+CREATE INDEX IF NOT EXISTS events_start_time ON events (start_time);
+CREATE INDEX IF NOT EXISTS events_category ON events (category, start_time);
+CREATE INDEX IF NOT EXISTS events_record_id ON events (record_id);
+CREATE INDEX IF NOT EXISTS events_source_id ON events (source_id, start_time);
+CREATE INDEX IF NOT EXISTS contacts_name ON contacts (last_name, first_name);
+CREATE INDEX IF NOT EXISTS contacts_category ON contacts (category);
+CREATE INDEX IF NOT EXISTS contacts_record_id ON contacts (record_id);
+"""
+
+
+class SqliteExport(object):
+    """Load datebooks and address books into a SQLite database.
+
+    Each source file is streamed once and loaded in a single transaction,
+    rows being written through executemany() in batches of batch_size.
+    Rows are keyed on (source file, UID), and hold the content hash of
+    their record: loading a file again only writes the rows whose record
+    changed, and deletes those whose record is gone. UIDs derive from
+    recordIDs, except for records whose recordID is 0 or already used in
+    the file: these get the UID of a record without ID, built from their
+    contents, so that no record overwrites another (see
+    Palm2vCalConverter.record_uid). Records without an ID repeating the
+    contents of an earlier one share its UID, and its row.
+
+    Events and contacts keep their decoded fields in a JSON 'data'
+    column (see Palm2vCalConverter.map_json); the columns used in queries
+    are indexed.
+
+    Attributes:
+        db_path: str, path of the SQLite database
+        src_encoding: the encoding to use when reading text from source
+            files
+        batch_size: int, number of rows per executemany() call
+        counts: dict with the number of 'inserted', 'updated', 'deleted'
+            and 'unchanged' rows
+    """
+
+    def __init__(self, db_path, src_encoding='cp1252', batch_size=1000):
+        self.db_path = db_path
+        self.src_encoding = src_encoding
+        self.batch_size = batch_size
+        self.counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        self.connection = sqlite3.connect(db_path)
+        self.create_schema()
+
+    def create_schema(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        tables = self.connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if tables and version != SCHEMA_VERSION:
+            raise ValueError("%r was created by another version of palm2vcal; "
+                "remove it to load the files again" % self.db_path)
+        self.connection.executescript(SCHEMA)
+        self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def close(self):
+        self.connection.close()
+
+    def source_id(self, path, header):
+        """Register a source file, returning its id."""
+        if header['versionTag'] == converter.ADDRESS_BOOK_TAG:
+            kind = 'addresses'
+        else:
+            kind = 'datebook'
+        file_name = unicode(header['fileName'], self.src_encoding)
+        cursor = self.connection.execute(
+            "SELECT id FROM sources WHERE path = ?", (path,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor = self.connection.execute(
+                "INSERT INTO sources (path, file_name, kind) VALUES (?, ?, ?)",
+                (path, file_name, kind))
+            return cursor.lastrowid
+        self.connection.execute(
+            "UPDATE sources SET file_name = ?, kind = ? WHERE id = ?",
+            (file_name, kind, row[0]))
+        return row[0]
+
+    def load_categories(self, source_id, categories):
+        self.connection.execute("DELETE FROM categories WHERE source_id = ?", (source_id,))
+        self.connection.executemany(
+            "INSERT INTO categories (source_id, idx, name) VALUES (?, ?, ?)",
+            [(source_id, index, name) for index, name in sorted(categories.items())])
+
+    def event_row(self, conv, e, uid):
+        data = conv.map_json(e, uid)
+        return (e['startTime'], e['endTime'], int(e['untimed']),
+            int(bool(e['repeatEvent']['repeatEventFlag'])), data['category'],
+            data['text'], data['note'], json.dumps(data, sort_keys=True))
+
+    def contact_row(self, conv, e, uid):
+        data = conv.map_json(e, uid)
+        return (data['lastName'], data['firstName'], data['companyName'],
+            data['category'], data['note'], json.dumps(data, sort_keys=True))
+
+    def load(self, path):
+        """Load a source file, replacing the rows of its previous load.
+
+        Args:
+            path: str, name of the .dba (or address book) file
+        """
+        path = os.path.abspath(path)
+        src_file = compression.open_file(path, 'rb')
+        try:
+            conv = converter.Palm2vCalConverter(src_file, src_encoding=self.src_encoding)
+            header, records = palmFile.iterPalmFileObject(src_file)
+            conv.load_header(header)
+            with self.connection:
+                source_id = self.source_id(path, header)
+                self.load_categories(source_id, conv.categories)
+                if header['versionTag'] == converter.ADDRESS_BOOK_TAG:
+                    self.load_records(source_id, records, 'contacts',
+                        ('last_name', 'first_name', 'company', 'category', 'note', 'data'),
+                        lambda e, uid: self.contact_row(conv, e, uid), conv)
+                else:
+                    self.load_records(source_id, records, 'events',
+                        ('start_time', 'end_time', 'untimed', 'repeating',
+                            'category', 'text', 'note', 'data'),
+                        lambda e, uid: self.event_row(conv, e, uid), conv)
+        finally:
+            src_file.close()
+
+    def load_records(self, source_id, records, table, columns, make_row, conv):
+        """Upsert the records of a source into table, in batches."""
+        known = dict(self.connection.execute(
+            "SELECT uid, digest FROM %s WHERE source_id = ?" % table, (source_id,)))
+        statement = "INSERT OR REPLACE INTO %s (source_id, uid, record_id, digest, %s) VALUES (%s)" % (
+            table, ', '.join(columns), ', '.join('?' * (len(columns) + 4)))
+
+        batch = []
+        record_ids = set()
+        loaded = set()
+        for e in records:
+            uid = conv.record_uid(e, record_ids)
+            if uid in loaded:
+                # Same contents as an earlier record without ID
+                continue
+            loaded.add(uid)
+            # Rows hold category names, which may change without the record
+            digest = conv.digest(dict(e, category=conv.categories.get(e['category'])))
+            previous = known.pop(uid, None)
+            if previous == digest:
+                self.counts['unchanged'] += 1
+                continue
+            self.counts['inserted' if previous is None else 'updated'] += 1
+            batch.append((source_id, uid, e['recordID'], digest) + make_row(e, uid))
+            if len(batch) >= self.batch_size:
+                self.connection.executemany(statement, batch)
+                batch = []
+        if batch:
+            self.connection.executemany(statement, batch)
+
+        self.connection.executemany(
+            "DELETE FROM %s WHERE source_id = ? AND uid = ?" % table,
+            [(source_id, uid) for uid in known])
+        self.counts['deleted'] += len(known)
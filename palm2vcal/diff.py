@@ -0,0 +1,157 @@
+# coding: utf-8
+
+import json
+
+import icalendar
+import palmFile
+
+from palm2vcal import converter
+
+
+class SnapshotDiff(object):
+    """Compute the changes between two .dba snapshots.
+
+    Records are matched on their UID, built the way SqliteExport keys its
+    rows: from the recordID, or from the contents for records whose
+    recordID is 0 or repeated in their snapshot (see
+    Palm2vCalConverter.record_uid). The old snapshot is reduced to a
+    UID -> content hash map in a first streaming pass, then the new
+    snapshot is streamed once against that map: both passes are linear,
+    and only the records that changed are ever mapped to events.
+
+    Attributes:
+        old_file: file object, the previous snapshot
+        new_file: file object, the current snapshot
+        sync_state: sync.SyncState, if set, gives events the SEQUENCE and
+            LAST-MODIFIED a conversion with the same state would give
+            them; cancelled events get the next SEQUENCE
+        converter: Palm2vCalConverter used to map records of new_file
+        counts: dict mapping each action to its number of records
+    """
+
+    ADDED = 'added'
+    CHANGED = 'changed'
+    DELETED = 'deleted'
+
+    def __init__(self, old_file, new_file, src_encoding='cp1252', uid_namespace=None,
+            sync_state=None):
+        self.old_file = old_file
+        self.new_file = new_file
+        self.sync_state = sync_state
+        self.converter = converter.Palm2vCalConverter(new_file, src_encoding=src_encoding,
+            uid_namespace=uid_namespace, sync_state=sync_state)
+        self.counts = dict((action, 0) for action in (self.ADDED, self.CHANGED, self.DELETED))
+
+    def index_old(self):
+        """Map UIDs to (digest, recordID, startTime, untimed) for the old snapshot.
+
+        UIDs use the namespace of the new snapshot, which must be known.
+        """
+        conv = converter.Palm2vCalConverter(self.old_file,
+            src_encoding=self.converter.src_encoding, uid_namespace=self.converter.uid_namespace)
+        header, records = palmFile.iterPalmFileObject(self.old_file)
+        index = {}
+        record_ids = set()
+        for e in records:
+            index[conv.record_uid(e, record_ids)] = (
+                conv.digest(e), e['recordID'], e['startTime'], e['untimed'])
+        return index
+
+    def changes(self):
+        """Yield (action, event, uid) tuples, streaming through the new snapshot.
+
+        Added and changed events are full palmFile events; deleted ones
+        only hold their recordID, startTime and untimed fields.
+        """
+        header, records = palmFile.iterPalmFileObject(self.new_file)
+        self.converter.load_header(header)
+        old = self.index_old()
+
+        record_ids = set()
+        matched = set()
+        for e in records:
+            uid = self.converter.record_uid(e, record_ids)
+            if uid in matched:
+                # Same contents as an earlier record without ID
+                continue
+            matched.add(uid)
+            previous = old.pop(uid, None)
+            if previous is None:
+                action = self.ADDED
+            elif previous[0] != self.converter.digest(e):
+                action = self.CHANGED
+            else:
+                if self.sync_state is not None:
+                    # Keep the entries of unchanged events
+                    self.sync_state.update(uid, previous[0])
+                continue
+            self.counts[action] += 1
+            yield action, e, uid
+
+        for uid in sorted(old):
+            digest, record_id, start_time, untimed = old[uid]
+            self.counts[self.DELETED] += 1
+            yield self.DELETED, {
+                'recordID': record_id,
+                'startTime': start_time,
+                'untimed': untimed,
+            }, uid
+
+    def map_update(self, e, uid):
+        """Convert an added or changed event into an icalendar.Event."""
+        return self.converter.map_event(e, uid=uid)
+
+    def map_cancel(self, e, uid):
+        """Convert a deleted event into a cancelled icalendar.Event."""
+        event = icalendar.Event()
+        event.add('uid', uid)
+        event.add('dtstart', self.converter.mkdate(e['startTime'], e['untimed']))
+        if self.sync_state is not None:
+            entry = self.sync_state.entries.get(uid)
+            event.add('sequence', entry[1] + 1 if entry is not None else 0)
+        event.add('status', 'CANCELLED')
+        return event
+
+    def export_ics(self, dst_file):
+        """Write changes as iCalendar to a file object.
+
+        Added and changed events go to a METHOD:PUBLISH calendar; deleted
+        ones follow in a METHOD:CANCEL calendar, in the same stream.
+        """
+        cancelled = []
+
+        def updates():
+            for action, e, uid in self.changes():
+                if action == self.DELETED:
+                    cancelled.append(self.map_cancel(e, uid))
+                else:
+                    yield self.map_update(e, uid)
+
+        self.converter.write_calendar(dst_file, updates(), method='PUBLISH')
+        if cancelled:
+            self.converter.write_calendar(dst_file, cancelled, method='CANCEL')
+
+    def export_json(self, dst_file):
+        """Write changes as a JSON list to a file object, one per line."""
+        separator = '[\n'
+        for action, e, uid in self.changes():
+            change = {
+                'action': action,
+                'recordID': e['recordID'],
+                'uid': uid,
+                'startTime': e['startTime'],
+            }
+            if action != self.DELETED:
+                change['summary'] = self.converter.clean(e['text'])
+            dst_file.write(separator + json.dumps(change, sort_keys=True))
+            separator = ',\n'
+        if separator == '[\n':
+            dst_file.write('[')
+        dst_file.write('\n]\n')
+
+    def export(self, dst_file, format='ics'):
+        """Write changes to a file object, as 'ics' or 'json'."""
+        if format == 'json':
+            self.export_json(dst_file)
+        else:
+            self.export_ics(dst_file)
@@ -0,0 +1,113 @@
+# coding: utf-8
+
+import datetime
+import heapq
+
+import icalendar
+import pytz
+
+
+class vUTCPeriod(object):
+    """A period of time, written in UTC as FREEBUSY values must be."""
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.params = icalendar.Parameters()
+
+    def to_ical(self):
+        return '%s/%s' % (utc_text(self.start), utc_text(self.end))
+
+
+def utc_text(ts):
+    return datetime.datetime.fromtimestamp(ts, pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+class FreeBusy(object):
+    """Compute busy time and double-bookings of a datebook in a window.
+
+    Occurrences are expanded over the whole window by an
+    occurrences.DatebookQuery (see DatebookQuery.spans). Busy intervals
+    are then merged, and overlaps found, by sweeping the occurrences in
+    start order: O(n log n) in the number of occurrences, plus the number
+    of overlapping pairs for overlaps().
+
+    Untimed (all day) events do not make anyone busy, and are left out
+    unless untimed is set.
+
+    Attributes:
+        query: occurrences.DatebookQuery over the datebook
+        untimed: bool, whether untimed events count as busy time
+    """
+
+    def __init__(self, query, untimed=False):
+        self.query = query
+        self.untimed = untimed
+
+    def spans(self, start, end):
+        """Occurrences overlapping a window, clipped to it.
+
+        Returns:
+            sorted list of (start, end, event index) tuples
+        """
+        return [(s if s > start else start, e if e < end else end, i)
+            for s, e, i in self.query.spans(start, end, self.untimed)
+            if e > s]
+
+    def busy(self, start, end):
+        """Merge the occurrences of a window into busy intervals.
+
+        Args:
+            start: int, timestamp of the beginning of the window, included
+            end: int, timestamp of the end of the window, excluded
+
+        Returns:
+            sorted list of disjoint (start, end) tuples
+        """
+        # Merged before being clipped: only the first and last intervals
+        # may stick out of the window
+        merged = []
+        for s, e, i in self.query.spans(start, end, self.untimed):
+            if merged and s <= merged[-1][1]:
+                if e > merged[-1][1]:
+                    merged[-1][1] = e
+            elif e > s:
+                merged.append([s, e])
+        if merged:
+            merged[0][0] = max(merged[0][0], start)
+            merged[-1][1] = min(merged[-1][1], end)
+        return [tuple(interval) for interval in merged]
+
+    def overlaps(self, start, end):
+        """Find the pairs of occurrences overlapping each other in a window.
+
+        Returns:
+            list of ((start, end, event index), (start, end, event index))
+            tuples, the first occurrence of each pair starting first
+        """
+        found = []
+        active = []
+        for span in self.spans(start, end):
+            # Drop the occurrences ending before this one starts
+            while active and active[0][0] <= span[0]:
+                heapq.heappop(active)
+            for active_end, other in active:
+                found.append((other, span))
+            heapq.heappush(active, (span[1], span))
+        return found
+
+    def to_ical(self, start, end, uid=None):
+        """Build a VFREEBUSY component for a window.
+
+        Returns:
+            icalendar.FreeBusy
+        """
+        component = icalendar.FreeBusy()
+        if uid is not None:
+            component.add('uid', uid)
+        component.add('dtstamp', datetime.datetime.now(pytz.utc))
+        component.add('dtstart', datetime.datetime.fromtimestamp(start, pytz.utc))
+        component.add('dtend', datetime.datetime.fromtimestamp(end, pytz.utc))
+        for s, e in self.busy(start, end):
+            component.add('freebusy', vUTCPeriod(s, e), encode=0)
+        return component
@@ -0,0 +1,226 @@
+# coding: utf-8
+
+import heapq
+import os
+import struct
+import tempfile
+
+import palmFile
+
+from palm2vcal import compression
+from palm2vcal import converter
+
+
+class DatebookMerge(object):
+    """Merge several .dba files into one deduplicated calendar.
+
+    Each source is streamed in startTime order, and the sources are
+    combined through a heap-based k-way merge: only one pending record
+    per source is held in memory.
+
+    Sources already sorted by startTime are read in a single streaming
+    pass, after a cheap structural scan checks their order. Other sources
+    are read through a (startTime, offset) index built by that scan and
+    sorted externally: runs of run_size entries are sorted in memory and
+    spilled to a temporary file, then merged back, so that memory use
+    does not grow with the number of records either. Compressed sources
+    are then read from a decompressed copy, since records are read back
+    by offset.
+
+    Duplicates are detected on a content hash of DEDUP_FIELDS. Since
+    duplicates share their startTime, hashes are only kept for the
+    startTime being merged.
+
+    Event UIDs are built from the base name of each source file, since
+    recordIDs are only unique within a file.
+
+    Attributes:
+        src_files: list of seekable file objects, the .dba files to merge
+        run_size: int, number of index entries sorted in memory at once
+        namespaces: list of the identities of src_files in event UIDs
+        converter: Palm2vCalConverter holding the unified category table
+        category_ids: dict mapping a category name to its unified index
+        counts: dict with the number of merged 'events' and of dropped
+            'duplicates'
+    """
+
+    DEDUP_FIELDS = ('text', 'startTime', 'endTime', 'untimed', 'repeatEvent')
+
+    # Spilled (startTime, offset) index entries
+    INDEX_ENTRY = struct.Struct('<LQ')
+
+    # Number of spilled entries read back at once, per run
+    CHUNK_SIZE = 1024
+
+    def __init__(self, src_files, src_encoding='cp1252', run_size=16384):
+        self.src_files = src_files
+        self.run_size = run_size
+        self.namespaces = [None] * len(src_files)
+        self.converter = converter.Palm2vCalConverter(None, src_encoding=src_encoding)
+        self.category_ids = {}
+        self.counts = {'events': 0, 'duplicates': 0}
+
+    def map_categories(self, header):
+        """Map the category indexes of a file to unified ones.
+
+        Returns:
+            dict mapping the file's category indexes to unified indexes
+        """
+        mapping = {}
+        for category in header['categoryList']:
+            name = self.converter.clean(category['longName'])
+            if name not in self.category_ids:
+                index = len(self.category_ids) + 1
+                self.category_ids[name] = index
+                self.converter.categories[index] = name
+            mapping[category['index']] = self.category_ids[name]
+        return mapping
+
+    def is_sorted(self, src_file):
+        """Check whether the records of a file are sorted by startTime."""
+        src_file.seek(0)
+        header, records = palmFile.scanPalmFileObject(src_file)
+        previous = None
+        for offset, fields in records:
+            if previous is not None and fields['startTime'] < previous:
+                return False
+            previous = fields['startTime']
+        return True
+
+    def load_header(self, source, header):
+        """Load the categories and identity of a source file.
+
+        Returns:
+            dict mapping the file's category indexes to unified indexes
+        """
+        name = getattr(self.src_files[source], 'name', None)
+        if name and not name.startswith('<'):
+            self.namespaces[source] = os.path.basename(name)
+        else:
+            self.namespaces[source] = header['fileName'] or 'palm-%d' % source
+        return self.map_categories(header)
+
+    def sorted_records(self, source):
+        """Yield the records of a source file in startTime order."""
+        src_file = self.src_files[source]
+        if self.is_sorted(src_file):
+            src_file.seek(0)
+            header, records = palmFile.iterPalmFileObject(src_file)
+            mapping = self.load_header(source, header)
+        else:
+            src_file.seek(0)
+            data_file = compression.open_input(src_file)
+            if compression.is_compressed(data_file):
+                # Records are read back by offset, and each backward seek
+                # would decompress the stream from its start again
+                src_file = compression.spool(data_file)
+            index = self.sorted_index(src_file)
+            src_file.seek(0)
+            header, records = palmFile.iterPalmFileObject(src_file)
+            mapping = self.load_header(source, header)
+            labels = palmFile.calendarEntryFields
+            records = (self._read_at(src_file, offset, labels) for start_time, offset in index)
+
+        try:
+            for e in records:
+                e['category'] = mapping.get(e['category'], 0)
+                yield e
+        finally:
+            if src_file is not self.src_files[source]:
+                src_file.close()
+
+    def sorted_index(self, src_file):
+        """Sort the (startTime, offset) tuples of the records of a file.
+
+        The index is only held in memory when it fits in a single run.
+
+        Returns:
+            iterator over the sorted tuples
+        """
+        src_file.seek(0)
+        header, scanned = palmFile.scanPalmFileObject(src_file)
+        run = []
+        runs = []
+        spill = None
+        try:
+            for offset, fields in scanned:
+                run.append((fields['startTime'], offset))
+                if len(run) >= self.run_size:
+                    if spill is None:
+                        spill = tempfile.TemporaryFile()
+                    runs.append(self._spill_run(spill, run))
+                    run = []
+        except:
+            if spill is not None:
+                spill.close()
+            raise
+        run.sort()
+        if spill is None:
+            return iter(run)
+        return self._merge_runs(spill, runs, run)
+
+    def _merge_runs(self, spill, runs, last_run):
+        try:
+            streams = [self._read_run(spill, start, count) for start, count in runs]
+            for entry in heapq.merge(iter(last_run), *streams):
+                yield entry
+        finally:
+            spill.close()
+
+    def _spill_run(self, spill, run):
+        """Sort a run and append it to spill, returning its (start, count)."""
+        run.sort()
+        spill.seek(0, os.SEEK_END)
+        start = spill.tell()
+        pack = self.INDEX_ENTRY.pack
+        spill.write(''.join(pack(*entry) for entry in run))
+        return start, len(run)
+
+    def _read_run(self, spill, start, count):
+        size = self.INDEX_ENTRY.size
+        while count:
+            n = min(count, self.CHUNK_SIZE)
+            # Runs share the spill file, each one remembers its position
+            spill.seek(start)
+            data = spill.read(n * size)
+            start += n * size
+            count -= n
+            for i in xrange(n):
+                yield self.INDEX_ENTRY.unpack_from(data, i * size)
+
+    def _read_at(self, src_file, offset, labels):
+        src_file.seek(offset)
+        return palmFile.readFRecord(src_file, labels)
+
+    def merged(self):
+        """Yield the deduplicated records of all files, by startTime.
+
+        Records come as (source, record) tuples, source being the index
+        of their file in src_files.
+        """
+        def keyed(source, records):
+            for position, e in enumerate(records):
+                yield e['startTime'], source, position, e
+
+        streams = [keyed(source, self.sorted_records(source))
+            for source in range(len(self.src_files))]
+
+        current = None
+        seen = set()
+        for start_time, source, position, e in heapq.merge(*streams):
+            if start_time != current:
+                current = start_time
+                seen.clear()
+            digest = palmFile.recordDigest(dict((field, e[field]) for field in self.DEDUP_FIELDS))
+            if digest in seen:
+                self.counts['duplicates'] += 1
+                continue
+            seen.add(digest)
+            self.counts['events'] += 1
+            yield source, e
+
+    def export(self, dst_file):
+        """Export merged events to a file object."""
+        events = (self.converter.map_event(e, self.namespaces[source])
+            for source, e in self.merged())
+        self.converter.write_calendar(dst_file, events)
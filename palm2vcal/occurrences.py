@@ -0,0 +1,410 @@
+# coding: utf-8
+
+import bisect
+import collections
+import datetime
+import operator
+import os
+import time
+
+import palmFile
+
+
+DAY = 60 * 60 * 24
+
+
+class DatebookQuery(object):
+    """Answer 'what happens between two times' on a parsed datebook.
+
+    Occurrences of repeating events are expanded per time bucket, and
+    kept in a bounded LRU cache holding, for each bucket, the occurrences
+    of every event: overlapping and repeated queries reuse expanded
+    buckets. Expansion jumps close to the bucket instead of walking from
+    the first occurrence of each event.
+
+    Occurrences follow getNextRepeatedEvent, stop at the endDate of their
+    repeat rule and skip their dateExceptions. Daily, weekly every week,
+    monthly by date and yearly rules are expanded on local dates instead,
+    through a table of local midnights: this needs a fraction of the time
+    conversions, and keeps the local time of occurrences across DST
+    changes. Results therefore differ from getNextRepeatedEvent in time
+    zones with DST, for:
+    events at a local time skipped when clocks go forward (02:30 in
+    Europe), moved an hour later that day only, where
+    getNextRepeatedEvent moves them an hour earlier from then on;
+    weekly events late in the evening, to which getNextRepeatedEvent adds
+    an occurrence on the day clocks go forward;
+    monthly and yearly events in summer time, which getNextRepeatedEvent
+    moves an hour later at each step.
+
+    Attributes:
+        calendar: the datebook, as returned by palmFile.readPalmFile
+        path: str, the file calendar was read from, if any; it is read
+            again, and the cache cleared, when it changes on disk
+        bucket_size: int, width of the cached buckets, in seconds
+        cache_size: int, maximum number of cached buckets
+        hits: int, number of bucket lookups served from the cache
+        misses: int, number of buckets expanded
+    """
+
+    def __init__(self, calendar, bucket_size=7 * DAY, cache_size=512):
+        self.path = None
+        self._stat = None
+        self.bucket_size = bucket_size
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._midnights = {}
+        self.load(calendar)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Build a query object reading its datebook from path."""
+        query = cls(palmFile.readPalmFile(path), **kwargs)
+        query.path = path
+        query._stat = query._file_stat()
+        return query
+
+    def _file_stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+    def load(self, calendar):
+        """Replace the datebook, dropping every cached expansion."""
+        self.calendar = calendar
+        self.events = palmFile.getEvents(calendar)
+        self._cache = collections.OrderedDict()
+
+        # Single events, sorted by startTime, for bisection
+        single = sorted((e['startTime'], i) for i, e in enumerate(self.events)
+            if not e['repeatEvent']['repeatEventFlag'])
+        self._single_starts = [start for start, i in single]
+        self._single_events = [i for start, i in single]
+        repeating = sorted((e['startTime'], i) for i, e in enumerate(self.events)
+            if e['repeatEvent']['repeatEventFlag'])
+        self._repeating_starts = [start for start, i in repeating]
+        self._repeating = [i for start, i in repeating]
+        # Expansion plans of repeating events, see _plan
+        self._plans = {}
+        # Event index -> (since, ts): ts is the first occurrence from since
+        self._upcoming = {}
+        self._durations = [e['endTime'] - e['startTime'] for e in self.events]
+        # Occurrences overlapping a window start at most this long before it
+        self._max_duration = max(self._durations or [0])
+
+    def refresh(self):
+        """Reload the datebook if its file changed since it was read.
+
+        Returns:
+            bool, whether the datebook was reloaded
+        """
+        if self.path is None:
+            return False
+        stat = self._file_stat()
+        if stat == self._stat:
+            return False
+        self.load(palmFile.readPalmFile(self.path))
+        self._stat = stat
+        return True
+
+    def _jump(self, ts, days):
+        """Move a timestamp by days, keeping its local time."""
+        lt = time.localtime(ts)
+        return int(time.mktime((lt[0], lt[1], lt[2] + days,
+            lt[3], lt[4], lt[5], 0, 0, -1)))
+
+    def _next(self, e, ts):
+        """Occurrence following the one at ts, None if it cannot move."""
+        next_ts = palmFile.getNextRepeatedEvent(
+            {'startTime': ts, 'repeatEvent': e['repeatEvent']})['startTime']
+        next_ts = int(next_ts)
+        if next_ts <= ts:
+            return None
+        return next_ts
+
+    def _first_from(self, e, target):
+        """First occurrence of a repeating event at or after target."""
+        ts = e['startTime']
+        repeat = e['repeatEvent']
+        interval = max(repeat['interval'], 1)
+        if ts < target and repeat['brand'] in (1, 2):
+            # Jump whole repeat periods, stopping one period short so that
+            # stepping to target does not miss any occurrence. Monthly and
+            # yearly rules left to stepping are those falling on missing
+            # days, which getNextRepeatedEvent moves to the next month for
+            # good: jumping from the event would not.
+            period = interval * (7 if repeat['brand'] == 2 else 1)
+            periods = (target - ts) // (period * DAY) - 1
+            if periods > 0:
+                ts = self._jump(ts, periods * period)
+
+        while ts is not None and ts < target:
+            ts = self._next(e, ts)
+        return ts
+
+    def _exceptions(self, e):
+        return set(time.localtime(exc)[:3] for exc in e['repeatEvent'].get('dateExceptions', ()))
+
+    def _local_day(self, ts):
+        """Split a timestamp into a local date ordinal and seconds in that day."""
+        lt = time.localtime(ts)
+        return datetime.date(lt[0], lt[1], lt[2]).toordinal(), lt[3] * 3600 + lt[4] * 60 + lt[5]
+
+    def _midnight(self, ordinal):
+        """Timestamp of the local midnight starting a day."""
+        ts = self._midnights.get(ordinal)
+        if ts is None:
+            day = datetime.date.fromordinal(ordinal)
+            ts = int(time.mktime((day.year, day.month, day.day, 0, 0, 0, 0, 0, -1)))
+            self._midnights[ordinal] = ts
+        return ts
+
+    def _local_ts(self, ordinal, seconds):
+        """Timestamp of a local time, from a date ordinal and seconds in that day."""
+        midnight = self._midnight(ordinal)
+        ts = midnight + seconds
+        if self._midnight(ordinal + 1) - midnight == DAY:
+            return ts
+        # The UTC offset changes that day: move by the change when past it.
+        # Unlike mktime(), this always picks the first of repeated local
+        # times, and moves skipped ones forward.
+        day, day_seconds = self._local_day(ts)
+        moved = ts - ((day - ordinal) * DAY + day_seconds - seconds)
+        if self._local_day(moved) == (ordinal, seconds):
+            return moved
+        return ts
+
+    def _plan(self, e):
+        """Prepare the expansion of a repeating event.
+
+        Returns:
+            ('day', anchor, last, seconds, exceptions, step, weekdays) for
+            daily, and weekly every week, rules: anchor is the local date
+            ordinal of the event, last the one of the end of its rule,
+            seconds its local time, exceptions a set of date ordinals,
+            step the days between two occurrences of daily rules and
+            weekdays the day ordinals modulo 7 of weekly ones;
+            ('month', anchor, last, seconds, exceptions, step, month, mday)
+            for monthly by date, and yearly, rules which never fall on a
+            day missing from a month: step is the months between two
+            occurrences, month the one of the event counted from year 0,
+            mday its day of the month;
+            ('step', exceptions) for the others, exceptions being a set
+            of local (year, month, day) tuples
+        """
+        repeat = e['repeatEvent']
+        brand = repeat['brand']
+        interval = repeat['interval']
+        if interval < 1:
+            return ('step', self._exceptions(e))
+        lt = time.localtime(e['startTime'])
+        if brand == 4 and lt[2] <= 28:
+            step = interval
+        elif brand == 5 and (lt[1], lt[2]) != (2, 29):
+            step = 12 * interval
+        elif brand == 1 or (brand == 2 and interval == 1):
+            step = interval
+        else:
+            return ('step', self._exceptions(e))
+
+        anchor = datetime.date(lt[0], lt[1], lt[2]).toordinal()
+        seconds = lt[3] * 3600 + lt[4] * 60 + lt[5]
+        last = self._local_day(repeat['endDate'])[0]
+        exceptions = set(self._local_day(exc)[0] for exc in repeat.get('dateExceptions', ()))
+        if brand in (4, 5):
+            return ('month', anchor, last, seconds, exceptions, step, lt[0] * 12 + lt[1] - 1, lt[2])
+        if brand == 1:
+            return ('day', anchor, last, seconds, exceptions, step, None)
+        # Days of the mask, Sunday first; ordinal 7 is a Sunday
+        mask = ord(repeat['brandDaysMask'])
+        weekdays = [day for day in xrange(7) if mask & (1 << day)]
+        return ('day', anchor, last, seconds, exceptions, 1, weekdays)
+
+    def expand(self, bucket):
+        """Occurrences of repeating events in a bucket.
+
+        Returns:
+            sorted tuple of (startTime, event index) tuples
+        """
+        if bucket in self._cache:
+            self.hits += 1
+            found = self._cache.pop(bucket)
+            self._cache[bucket] = found
+            return found
+
+        self.misses += 1
+        low = bucket * self.bucket_size
+        found = tuple(sorted(self._expand_window(low, low + self.bucket_size)))
+
+        self._cache[bucket] = found
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return found
+
+    def _expand_window(self, low, high, untimed=True):
+        """Occurrences of repeating events between low and high, unsorted.
+
+        Untimed events are left out unless untimed is set.
+
+        Returns:
+            list of (startTime, event index) tuples
+        """
+        # Local days that may hold occurrences of the window, and their
+        # midnights; days lasting 24 hours need no time conversion
+        low_day = self._local_day(low)[0] - 1
+        high_day = self._local_day(high)[0] + 1
+        midnights = [self._midnight(day) for day in xrange(low_day, high_day + 2)]
+        regular = [midnights[k + 1] - midnights[k] == DAY for k in xrange(len(midnights) - 1)]
+        low_date = datetime.date.fromordinal(low_day)
+        high_date = datetime.date.fromordinal(high_day)
+        low_month = low_date.year * 12 + low_date.month - 1
+        high_month = high_date.year * 12 + high_date.month - 1
+
+        found = []
+        events = self.events
+        plans = self._plans
+        started = bisect.bisect_left(self._repeating_starts, high)
+        for i in self._repeating[:started]:
+            e = events[i]
+            end_date = e['repeatEvent']['endDate']
+            if end_date < low or (e['untimed'] and not untimed):
+                continue
+            plan = plans.get(i)
+            if plan is None:
+                plan = plans[i] = self._plan(e)
+
+            if plan[0] != 'step':
+                kind, anchor, last, seconds, exceptions, step = plan[:6]
+                first = max(low_day, anchor)
+                last = min(high_day, last)
+                if kind == 'month':
+                    month, mday = plan[6:]
+                    if month < low_month:
+                        month += (low_month - month + step - 1) // step * step
+                    days = [day for day in [datetime.date(m // 12, m % 12 + 1, mday).toordinal()
+                        for m in xrange(month, high_month + 1, step)] if first <= day <= last]
+                elif plan[6] is None:
+                    first = anchor - (anchor - first) // step * step
+                    days = xrange(first, last + 1, step)
+                else:
+                    # Unsorted, as found is; the event itself may be out
+                    # of its mask
+                    weekdays = plan[6]
+                    days = []
+                    for weekday in weekdays:
+                        days.extend(xrange(first + (weekday - first) % 7, last + 1, 7))
+                    if first == anchor <= last and anchor % 7 not in weekdays:
+                        days.append(anchor)
+                for day in days:
+                    k = day - low_day
+                    if day == anchor:
+                        ts = e['startTime']
+                    elif regular[k]:
+                        ts = midnights[k] + seconds
+                    else:
+                        ts = self._local_ts(day, seconds)
+                    if low <= ts < high and ts <= end_date and day not in exceptions:
+                        found.append((ts, i))
+                continue
+
+            # Other rules step from one occurrence to the next, starting
+            # from where the previous window stopped when possible
+            upcoming = self._upcoming.get(i)
+            if upcoming is not None and upcoming[0] <= low:
+                ts = upcoming[1]
+                if ts is None or ts >= high:
+                    continue
+                while ts is not None and ts < low:
+                    ts = self._next(e, ts)
+            else:
+                ts = self._first_from(e, low)
+            exceptions = plan[1]
+            while ts is not None and ts < high and ts <= end_date:
+                if not exceptions or time.localtime(ts)[:3] not in exceptions:
+                    found.append((ts, i))
+                ts = self._next(e, ts)
+            self._upcoming[i] = (high, ts)
+        return found
+
+    def _occurrence(self, e, start):
+        occurrence = e.copy()
+        occurrence['startTime'] = start
+        occurrence['endTime'] = start + (e['endTime'] - e['startTime'])
+        return occurrence
+
+    def occurrences(self, start, end):
+        """List the occurrences starting between start and end.
+
+        Args:
+            start: int, timestamp of the beginning of the window, included
+            end: int, timestamp of the end of the window, excluded
+
+        Returns:
+            list of palmFile event dicts, one per occurrence, with their
+            startTime and endTime moved to the occurrence; sorted by
+            startTime
+        """
+        self.refresh()
+        found = []
+
+        first = bisect.bisect_left(self._single_starts, start)
+        last = bisect.bisect_left(self._single_starts, end)
+        for i in self._single_events[first:last]:
+            e = self.events[i]
+            found.append((e['startTime'], i, e.copy()))
+
+        for bucket in xrange(start // self.bucket_size, (end - 1) // self.bucket_size + 1):
+            for ts, i in self.expand(bucket):
+                if start <= ts < end:
+                    found.append((ts, i, self._occurrence(self.events[i], ts)))
+
+        found.sort(key=lambda occurrence: occurrence[:2])
+        return [e for ts, i, e in found]
+
+    def spans(self, start, end, untimed=True):
+        """List the occurrences overlapping a window, without copying events.
+
+        Meant for wide windows: repeating events are expanded over the
+        whole window at once, bypassing the bucket cache.
+
+        Args:
+            start: int, timestamp of the beginning of the window, included
+            end: int, timestamp of the end of the window, excluded
+            untimed: bool, whether to include untimed (all day) events
+
+        Returns:
+            list of (startTime, endTime, event index) tuples, sorted by
+            startTime; ties are left in a stable, unspecified order
+        """
+        self.refresh()
+        low = start - self._max_duration
+        events = self.events
+        found = []
+
+        first = bisect.bisect_left(self._single_starts, low)
+        last = bisect.bisect_left(self._single_starts, end)
+        for i in self._single_events[first:last]:
+            e = events[i]
+            if e['endTime'] > start and (untimed or not e['untimed']):
+                found.append((e['startTime'], e['endTime'], i))
+
+        durations = self._durations
+        found.extend([(ts, ts + durations[i], i)
+            for ts, i in self._expand_window(low, end, untimed) if ts + durations[i] > start])
+
+        # Comparing whole tuples costs about half as much again
+        found.sort(key=operator.itemgetter(0))
+        return found
+
+    def on_day(self, day):
+        """List the occurrences of a datetime.date, in local time."""
+        start = int(time.mktime(day.timetuple()))
+        end = int(time.mktime((day + datetime.timedelta(days=1)).timetuple()))
+        return self.occurrences(start, end)
+
+    def on_week(self, day):
+        """List the occurrences of the week (from Monday) holding day."""
+        monday = day - datetime.timedelta(days=day.weekday())
+        start = int(time.mktime(monday.timetuple()))
+        end = int(time.mktime((monday + datetime.timedelta(days=7)).timetuple()))
+        return self.occurrences(start, end)
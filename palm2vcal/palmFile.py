@@ -216,7 +216,13 @@ calendarEntryFields = (
 # (not to be accessed by user)
 ###
 
+import cStringIO
+import hashlib
+import os
 import struct
+import tempfile
+
+import compression
 
 def readCString(f):
     """Read in a Palm-format string."""
@@ -452,13 +458,14 @@ def writeField(f, fieldType, s):
     else:
         raise ValueError()
 
-def readFRecords(f, fileSoFar, labels):
+def readFRecords(f, fileSoFar, labels, accept=None):
     """reads a list of frecords from file f
     
     returns -- a list of records
     fileSoFar -- dictionary of data read so far, used to get the number
                 of records to read
     labels -- a list of labels for the fields
+    accept -- optional predicate selecting records, see readFilteredFRecord
     """
     if readDebug:
         print '---------------------------------'
@@ -467,23 +474,118 @@ def readFRecords(f, fileSoFar, labels):
         import pprint
         pprint.pprint(fileSoFar)
 
+    return list(iterFRecords(f, fileSoFar, labels, accept))
+
+def iterFRecords(f, fileSoFar, labels, accept=None):
+    """yields frecords from file f, one at a time
+
+    Same arguments as readFRecords; only the record being read is kept
+    in memory.
+    """
     fieldsPerRecord = fileSoFar['fieldCount']
     # make sure that declared 
     if fieldsPerRecord != len(labels):
         raise ValueError()
 
     numberOfRecords = fileSoFar['numEntries'] / fieldsPerRecord;
-#    print "reading", str(numberOfRecords), "records"
-    entries = []
-    for i in range(numberOfRecords):
-#        print "reading record", str(i)
-        newEntry = {}
-        for j in labels:
-            fieldType = readLong(f)
-            newEntry[j] = readField(f, fieldType)
-        entries.append(newEntry)
-#    print "done with", str(numberOfRecords), "records"
-    return entries
+    if accept is None:
+        for i in xrange(numberOfRecords):
+            yield readFRecord(f, labels)
+    else:
+        # A single scanner, so that errors report the offset from the
+        # start of the file and the index of the frecord
+        s = _Scanner(_RecordingReader(f))
+        s.offset = _tell(f)
+        for i in xrange(numberOfRecords):
+            s.record = i
+            newEntry = _readFilteredFRecord(s, fileSoFar, labels, accept)
+            if newEntry is not None:
+                yield newEntry
+
+def readFRecord(f, labels):
+    """reads a single frecord from file f
+
+    labels -- a list of labels for the fields
+    """
+    newEntry = {}
+    for j in labels:
+        fieldType = readLong(f)
+        newEntry[j] = readField(f, fieldType)
+    return newEntry
+
+class _RecordingReader(object):
+    """Reads from a file, keeping what was read"""
+
+    def __init__(self, f):
+        self.f = f
+        self.chunks = []
+
+    def read(self, n):
+        data = self.f.read(n)
+        self.chunks.append(data)
+        return data
+
+def _tell(f):
+    """Position of file f, 0 when it cannot tell"""
+    try:
+        return f.tell()
+    except (AttributeError, IOError):
+        return 0
+
+def readFilteredFRecord(f, fileSoFar, labels, accept, offset=0, record=None):
+    """reads a single frecord from file f, if accept selects it
+
+    The frecord is first walked as by scanPalmFileObject: strings and
+    repeat events are not decoded, and nothing of rejected frecords is.
+    Accepted frecords are then decoded from the bytes kept in memory, so
+    f is only read forward and may be a pipe.
+
+    fileSoFar -- dictionary of data read so far
+    labels -- a list of labels for the fields
+    accept -- a predicate called with the fields of the frecord, as
+                scanPalmFileObject yields them, and fileSoFar
+    offset -- position of the frecord in the file, reported by PalmFileError
+    record -- index of the frecord, reported by PalmFileError
+    returns -- the frecord, None when it was rejected
+    """
+    s = _Scanner(_RecordingReader(f))
+    s.offset = offset
+    s.record = record
+    return _readFilteredFRecord(s, fileSoFar, labels, accept)
+
+def _readFilteredFRecord(s, fileSoFar, labels, accept):
+    """readFilteredFRecord, with a _Scanner reading from a _RecordingReader"""
+    reader = s.f
+    reader.chunks = []
+    fields = {}
+    for label in labels:
+        fields[label] = _checkField(s)
+    if not accept(fields, fileSoFar):
+        return None
+    return readFRecord(cStringIO.StringIO(''.join(reader.chunks)), labels)
+
+def _canonicalRepr(value):
+    """Stable representation of a value read from a palm file."""
+    if isinstance(value, dict):
+        return '{%s}' % ','.join(['%r:%s' % (k, _canonicalRepr(value[k]))
+            for k in sorted(value)])
+    elif isinstance(value, list):
+        return '[%s]' % ','.join([_canonicalRepr(v) for v in value])
+    return repr(value)
+
+def recordDigest(entry, exclude=()):
+    """Compute a content hash of a record, as read by readFRecords
+
+    The digest does not depend on dictionary ordering, so it is stable
+    across runs and processes.
+    exclude -- names of fields left out of the digest
+    returns -- a hex sha1 digest
+    """
+    digest = hashlib.sha1()
+    for label in sorted(entry):
+        if label not in exclude:
+            digest.update('%r:%s;' % (label, _canonicalRepr(entry[label])))
+    return digest.hexdigest()
 
 def writeFRecords(f, fieldEntryList, labels, list):
     """writes a list of frecords to file f
@@ -521,11 +623,12 @@ def writeFRecords(f, fieldEntryList, labels, list):
             writeLong(f, fieldType)
             writeField(f, fieldType, item[labels[i]])
 
-def readRecords(f, fileFormat, howMany=1, versionTag=None):
+def readRecords(f, fileFormat, howMany=1, versionTag=None, accept=None):
     """reads a list of objects from a file f
     
     fileFormat -- HEADERDEF of what format looks like
     howMany -- how many records to read
+    accept -- optional predicate selecting frecords, see readFilteredFRecord
     returns a list of howMany dictionaries: [ {d1}, .... {dN}]
     """
     retVal = []
@@ -550,7 +653,7 @@ def readRecords(f, fileFormat, howMany=1, versionTag=None):
             elif fieldDef[1] == "record":
                 entry[fieldDef[0]] = readRecords(f, eval(fieldDef[2]), entry[fieldDef[3]])
             elif fieldDef[1] == "frecord":
-                entry[fieldDef[0]] = readFRecords(f, entry, eval(fieldDef[2]))
+                entry[fieldDef[0]] = readFRecords(f, entry, eval(fieldDef[2]), accept)
             else:
                 raise AssertionError()
         retVal.append(entry);
@@ -598,17 +701,345 @@ def writeRecords(f, fileFormat, list):
                 raise AssertionError()
 
 
+###
+# Structural validation
+# (walks a file using only lengths and type tags, nothing is decoded)
+###
+
+# Sanity limit used by validatePalmFile; string lengths and date exception
+# counts are 16-bit values, only bounded by the size of the file
+maxCategoryCount = 256
+
+class PalmFileError(ValueError):
+    """Raised when a palm file is not structurally valid.
+
+    offset -- byte offset of the first problem, from the start of the file
+    record -- index of the frecord holding the problem, None for the header
+    """
+    def __init__(self, message, offset, record=None):
+        ValueError.__init__(self, message)
+        self.message = message
+        self.offset = offset
+        self.record = record
+
+    def __str__(self):
+        if self.record is None:
+            where = "header"
+        else:
+            where = "record %d" % self.record
+        return "%s (offset %d, %s)" % (self.message, self.offset, where)
+
+class _Scanner(object):
+    """Bounds-checked reader keeping track of the current offset."""
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+        self.record = None
+        self.size = None
+        self.seekable = False
+        try:
+            start = f.tell()
+            f.seek(0, 2)
+            self.size = f.tell() - start
+            f.seek(start)
+            self.seekable = True
+        except (AttributeError, IOError):
+            pass
+
+    def error(self, message, offset=None):
+        if offset is None:
+            offset = self.offset
+        raise PalmFileError(message, offset, self.record)
+
+    def remaining(self):
+        if self.size is None:
+            return None
+        return self.size - self.offset
+
+    def need(self, n):
+        left = self.remaining()
+        if left is not None and n > left:
+            self.error("Truncated file: %d bytes needed, %d left" % (n, left))
+
+    def read(self, n):
+        try:
+            data = self.f.read(n)
+        except PalmFileError, e:
+            # Corrupt compressed data, which the reader cannot locate
+            raise PalmFileError(e.message, e.offset, self.record)
+        if len(data) != n:
+            self.error("Truncated file: %d bytes needed, %d left" % (n, len(data)))
+        self.offset += n
+        return data
+
+    def skip(self, n):
+        self.need(n)
+        if self.seekable:
+            self.f.seek(n, 1)
+            self.offset += n
+        else:
+            self.read(n)
+
+    def readShort(self):
+        (retVal,) = struct.unpack("<H", self.read(2))
+        return retVal
+
+    def readLong(self):
+        (retVal,) = struct.unpack("<L", self.read(4))
+        return retVal
+
+    def skipCString(self):
+        (length, ) = struct.unpack("B", self.read(1))
+        if length == 0xFF:
+            length = self.readShort()
+        self.skip(length)
+
+def _checkRepeatEvent(s):
+    """Walk a RepeatEvent, mirroring readRepeatEvent.
+
+    returns -- the repeatEventFlag
+    """
+    count = s.readShort()
+    s.skip(4 * count)
+
+    flag = s.readShort()
+    if flag == 0x0:
+        return flag
+    if flag == 0xFFFF:
+        s.skip(2) # constant
+        s.skip(s.readShort()) # class name
+
+    start = s.offset
+    brand = s.readLong()
+    if brand > 6:
+        s.error("Unknown repeat brand %d" % brand, start)
+    s.skip(12) # interval, endDate, firstDayOfWeek
+    if brand in (1, 2, 3):
+        s.skip(4) # brandDayIndex
+    if brand == 2:
+        s.skip(1) # brandDaysMask
+    if brand == 3:
+        s.skip(4) # brandWeekIndex
+    if brand in (4, 5):
+        s.skip(4) # brandDayNumber
+    if brand == 5:
+        s.skip(4) # brandMonthIndex
+    return flag
+
+def _checkField(s):
+    """Walk a type-tagged field, mirroring readField.
+
+    returns -- the value of fixed-width fields, the repeatEventFlag of
+                repeat events, and None for skipped strings
+    """
+    start = s.offset
+    fieldType = s.readLong()
+    retVal = None
+    if fieldType == 0: # none
+        pass
+    elif fieldType in (1, 3, 7): # integer, date, bit flag
+        retVal = s.readLong()
+    elif fieldType == 2: # float
+        (retVal,) = struct.unpack("<f", s.read(4))
+    elif fieldType == 5: # cstring
+        s.skip(4) # padding
+        s.skipCString()
+    elif fieldType == 6: # boolean
+        retVal = (s.readLong() != 0)
+    elif fieldType == 8: # repeat event
+        retVal = _checkRepeatEvent(s)
+    else:
+        s.error("Unsupported field type %d" % fieldType, start)
+    return retVal
+
+def _checkFRecords(s, fileSoFar, labels):
+    """Walk a list of frecords, mirroring iterFRecords.
+
+    yields -- an (offset, fields) tuple per frecord, where fields maps
+                labels to what _checkField returned
+    """
+    fieldsPerRecord = fileSoFar['fieldCount']
+    if fieldsPerRecord != len(labels):
+        s.error("Records have %d fields, %d expected" %
+            (fieldsPerRecord, len(labels)))
+    numEntries = fileSoFar['numEntries']
+    if numEntries % fieldsPerRecord:
+        s.error("numEntries %d is not a multiple of %d fields" %
+            (numEntries, fieldsPerRecord))
+    # Each field holds at least its 4 bytes type tag
+    s.need(4 * numEntries)
+
+    numberOfRecords = numEntries / fieldsPerRecord
+    for i in xrange(numberOfRecords):
+        s.record = i
+        offset = s.offset
+        fields = {}
+        for label in labels:
+            fields[label] = _checkField(s)
+        yield offset, fields
+    s.record = None
+
+def _checkRecords(s, fileFormat):
+    """Walk a single record, mirroring readRecords.
+
+    Strings are skipped, so only numeric items are returned.
+    frecords are not walked; fileFormat must not hold any.
+    """
+    entry = {}
+    for fieldDef in fileFormat:
+        if fieldDef[1] == "long":
+            entry[fieldDef[0]] = s.readLong()
+        elif fieldDef[1] == "short":
+            entry[fieldDef[0]] = s.readShort()
+        elif fieldDef[1] == "cstring":
+            s.skipCString()
+        elif fieldDef[1] == "record":
+            count = entry[fieldDef[3]]
+            if count > maxCategoryCount:
+                s.error("%s %d exceeds the %d limit" %
+                    (fieldDef[3], count, maxCategoryCount))
+            for i in range(count):
+                _checkRecords(s, eval(fieldDef[2]))
+        else:
+            raise AssertionError()
+    return entry
+
+def _checkPalmFile(s):
+    """Walk the header of a palm file.
+
+    returns -- a (header, records) tuple, see scanPalmFileObject
+    """
+    sig = s.read(4)
+    if sig == "\x00\x01BA": # address book
+        fileFormat = addressHeaderDef
+    elif sig == "\x00\x01BD": # datebook (calendar)
+        fileFormat = calendarHeaderDef
+    else:
+        s.error("Unknown file format %r" % sig, 0)
+    header = _checkRecords(s, fileFormat[1:-1])
+    header['versionTag'] = sig
+    recordsDef = fileFormat[-1]
+    return header, _checkFRecords(s, header, eval(recordsDef[2]))
+
+
+###
+# In-place editing
+# (frecords are located by offset, only what changed is written)
+###
+
+copyChunkSize = 256 * 1024
+
+def encodeFRecord(fieldEntryList, labels, entry):
+    """Encode a single frecord, as writeFRecords would write it
+
+    returns -- the bytes of the frecord
+    """
+    buf = cStringIO.StringIO()
+    writeFRecords(buf, fieldEntryList, labels, [entry])
+    return buf.getvalue()
+
+def _locateFRecords(f):
+    """Find the frecords of a seekable, uncompressed palm file
+
+    Only the header is decoded, frecords are walked by _checkFRecords.
+    returns -- a (header, fileFormat, layout) tuple; layout maps
+                'nextFree' and 'numEntries' to the offsets of these header
+                items, 'end' to the end of the last frecord and 'records'
+                to a list of (offset, recordID) tuples
+    """
+    f.seek(0)
+    sig = f.read(4)
+    if compression.detect(sig) is not None:
+        raise ValueError("Compressed palm files cannot be edited")
+    if sig == "\x00\x01BA": # address book
+        fileFormat = addressHeaderDef
+    elif sig == "\x00\x01BD": # datebook (calendar)
+        fileFormat = calendarHeaderDef
+    else:
+        print "Unknown file format ", sig
+        raise ValueError()
+    header = readRecords(f, fileFormat[:-1], 1, versionTag=sig)[0]
+    start = f.tell()
+
+    # nextFree follows the fileName and tableString items
+    f.seek(4)
+    readCString(f)
+    readCString(f)
+    nextFree = f.tell()
+    f.seek(start)
+
+    s = _Scanner(f)
+    records = [(start + offset, fields['recordID'])
+        for offset, fields in _checkFRecords(s, header, eval(fileFormat[-1][2]))]
+    layout = {
+        'nextFree': nextFree,
+        'numEntries': start - 4,
+        'end': start + s.offset,
+        'records': records,
+    }
+    return header, fileFormat, layout
+
+def _copyBytes(src, dst, start, end):
+    """Copy bytes start to end of file src to file dst"""
+    src.seek(start)
+    while start < end:
+        data = src.read(min(copyChunkSize, end - start))
+        if not data:
+            raise PalmFileError("Truncated file", start)
+        dst.write(data)
+        start += len(data)
+
+def _syncFile(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def _rewritePalmFile(f, fileName, layout, edits, appended, numEntries, nextFree):
+    """Write an edited copy of palm file f, and rename it over fileName
+
+    Unchanged bytes are copied from f, without decoding.
+    edits -- sorted list of (offset, oldSize, data) tuples
+    """
+    # A new file next to fileName, so that the rename stays atomic
+    fd, tmpName = tempfile.mkstemp(prefix=os.path.basename(fileName) + '.',
+        suffix='.tmp', dir=os.path.dirname(os.path.abspath(fileName)))
+    tmpFile = os.fdopen(fd, "wb")
+    try:
+        _copyBytes(f, tmpFile, 0, layout['nextFree'])
+        writeLong(tmpFile, nextFree)
+        _copyBytes(f, tmpFile, layout['nextFree'] + 4, layout['numEntries'])
+        writeLong(tmpFile, numEntries)
+        position = layout['numEntries'] + 4
+        for offset, oldSize, data in edits:
+            _copyBytes(f, tmpFile, position, offset)
+            tmpFile.write(data)
+            position = offset + oldSize
+        _copyBytes(f, tmpFile, position, layout['end'])
+        tmpFile.write(appended)
+        _syncFile(tmpFile)
+    except:
+        tmpFile.close()
+        os.remove(tmpName)
+        raise
+    tmpFile.close()
+    os.chmod(tmpName, os.stat(fileName).st_mode & 07777)
+    os.rename(tmpName, fileName)
+
+
 ######################
 # MAIN FUNCTIONS
 ######################
 
-def readPalmFile(fileName):
+def readPalmFile(fileName, accept=None):
     """ Read in a Palm fileName with a specified format
     
     The type of the file is determined automatically by reading
-    the first four bytes
+    the first four bytes; gzip, bzip2 and xz compressed files are
+    detected as well.
     fileFormat -- different files have different formats (address book, calendar...)
                 [abHeaderDef | calHeaderDef]
+    accept -- optional predicate selecting frecords, see readFilteredFRecord;
+                numEntries still counts all of them
     """
     retVal = None
     try:
@@ -618,13 +1049,19 @@ def readPalmFile(fileName):
         raise
 
     try:
-        result = readPalmFileObject(palmFile)
+        result = readPalmFileObject(palmFile, accept)
     finally:
         palmFile.close()
     return result
 
-def readPalmFileObject(file_obj):
+def readPalmFileObject(file_obj, accept=None):
+    """ Read in a Palm file object
+
+    gzip, bzip2 and xz compressed files are decompressed on the fly.
+    accept -- optional predicate selecting frecords, see readPalmFile
+    """
     try:
+        file_obj = compression.open_input(file_obj)
         sig = file_obj.read(4)
 #        file_obj.seek(0)
         if sig == "\x00\x01BA": # address book
@@ -634,12 +1071,87 @@ def readPalmFileObject(file_obj):
         else:
             print "Unknown file format ", sig
             raise ValueError()
-        retVal = readRecords(file_obj, fileFormat, 1, versionTag=sig)
+        retVal = readRecords(file_obj, fileFormat, 1, versionTag=sig, accept=accept)
     except IOError:
         print "Unexpected error while reading Palm file"
         raise
     return retVal
 
+def iterPalmFileObject(file_obj, accept=None):
+    """Read a Palm file object one record at a time
+
+    accept -- optional predicate selecting frecords, see readFilteredFRecord
+    returns -- a (header, records) tuple. header is the dictionary
+                readPalmFileObject would return, without its list of
+                frecords; records iterates over those frecords, reading
+                them from file_obj as it goes.
+    """
+    file_obj = compression.open_input(file_obj)
+    sig = file_obj.read(4)
+    if sig == "\x00\x01BA": # address book
+        fileFormat = addressHeaderDef
+    elif sig == "\x00\x01BD": # datebook (calendar)
+        fileFormat = calendarHeaderDef
+    else:
+        print "Unknown file format ", sig
+        raise ValueError()
+    header = readRecords(file_obj, fileFormat[:-1], 1, versionTag=sig)[0]
+    recordsDef = fileFormat[-1]
+    return header, iterFRecords(file_obj, header, eval(recordsDef[2]), accept)
+
+def validatePalmFile(fileName):
+    """Check the structure of a Palm fileName without decoding it
+
+    raises PalmFileError on the first problem found
+    returns -- a summary dictionary, see validatePalmFileObject
+    """
+    palmFile = open(fileName, "rb")
+    try:
+        result = validatePalmFileObject(palmFile)
+    finally:
+        palmFile.close()
+    return result
+
+def validatePalmFileObject(file_obj):
+    """Check the structure of a Palm file object without decoding it
+
+    Only lengths and type tags are read, strings are skipped over.
+    Declared sizes are checked, when the file object is seekable, against
+    the file size, and category counts against maxCategoryCount.
+    Offsets in compressed files refer to the decompressed data.
+
+    raises PalmFileError on the first problem found
+    returns -- a dictionary with the versionTag, numRecords and size
+                (in bytes) of the walked file
+    """
+    s = _Scanner(compression.open_input(file_obj))
+    header, records = _checkPalmFile(s)
+    numberOfRecords = 0
+    for offset, fields in records:
+        numberOfRecords += 1
+    return {
+        'versionTag': header['versionTag'],
+        'numRecords': numberOfRecords,
+        'size': s.offset,
+    }
+
+def scanPalmFileObject(file_obj):
+    """Walk a Palm file object one frecord at a time, without decoding it
+
+    Strings are skipped over, with the same checks as
+    validatePalmFileObject; this is much cheaper than iterPalmFileObject
+    when only offsets and numeric fields are needed.
+
+    raises PalmFileError on the first problem found
+    returns -- a (header, records) tuple. header only holds the numeric
+                items of the file header; records yields an
+                (offset, fields) tuple per frecord, where offset is
+                relative to the initial position of file_obj and fields
+                maps labels to their value for fixed-width fields, to the
+                repeatEventFlag for repeat events and to None for strings.
+    """
+    return _checkPalmFile(_Scanner(compression.open_input(file_obj)))
+
 def writePalmFile(fileName, fileData):
     '''Writes a palm desktop file
     '''
@@ -683,6 +1195,73 @@ def writePalmFile(fileName, fileData):
         raise
     if palmFile : palmFile.close()
 
+def updatePalmFile(fileName, changes=None, additions=(), atomic=False):
+    """Change and append records of a Palm fileName, without rewriting it all
+
+    Records are located by their offset, only the header is decoded.
+    Changed records which keep their encoded size are overwritten in
+    place; added records are written after the last one, then the
+    numEntries (and nextFree) items of the header are patched, so that
+    an interrupted append leaves the previous records only.
+    When a changed record changes size, or when atomic is set, an edited
+    copy is written to a temporary file and renamed over fileName; the
+    unchanged bytes are copied without being decoded.
+
+    changes -- dictionary mapping recordIDs to their new record
+    additions -- list of records to append
+    atomic -- never write to fileName in place, so that an interrupted
+              update always leaves it untouched
+    raises KeyError when a recordID of changes is not in the file
+    returns -- the new number of records
+    """
+    if changes is None:
+        changes = {}
+    palmFile = open(fileName, "r+b")
+    try:
+        header, fileFormat, layout = _locateFRecords(palmFile)
+        labels = eval(fileFormat[-1][2])
+        # fieldEntry for datebooks, fieldEntryList for address books
+        fieldEntryList = header[fileFormat[-3][0]]
+
+        pending = dict(changes)
+        records = layout['records']
+        ends = [offset for offset, recordID in records[1:]] + [layout['end']]
+        edits = []
+        for (offset, recordID), end in zip(records, ends):
+            if recordID in pending:
+                data = encodeFRecord(fieldEntryList, labels, pending.pop(recordID))
+                edits.append((offset, end - offset, data))
+        if pending:
+            raise KeyError(min(pending))
+
+        appended = ''.join([encodeFRecord(fieldEntryList, labels, entry)
+            for entry in additions])
+        numEntries = header['numEntries'] + len(additions) * len(labels)
+        nextFree = max([header['nextFree']] +
+            [entry['recordID'] + 1 for entry in additions])
+
+        resized = [edit for edit in edits if len(edit[2]) != edit[1]]
+        if atomic or resized:
+            _rewritePalmFile(palmFile, fileName, layout, edits, appended,
+                numEntries, nextFree)
+        else:
+            for offset, oldSize, data in edits:
+                palmFile.seek(offset)
+                palmFile.write(data)
+            if appended:
+                palmFile.seek(layout['end'])
+                palmFile.write(appended)
+                palmFile.truncate()
+                _syncFile(palmFile)
+                palmFile.seek(layout['nextFree'])
+                writeLong(palmFile, nextFree)
+                palmFile.seek(layout['numEntries'])
+                writeLong(palmFile, numEntries)
+            _syncFile(palmFile)
+    finally:
+        palmFile.close()
+    return numEntries / len(labels)
+
 def printAllNames(adBook):
     """print all names in the address book
 
@@ -818,11 +1397,25 @@ def getNextRepeatedEvent(event):
 def getAppointment(event):
     return event
 
-def createAppointment(event):
+def createAppointment(fileName, event):
+    """Append an event to the datebook fileName
+
+    When event has no recordID, it is given the nextFree one of the file.
+    returns -- event
+    """
+    if event.get('recordID') is None:
+        palmFile = open(fileName, "rb")
+        try:
+            header, records = iterPalmFileObject(palmFile)
+        finally:
+            palmFile.close()
+        event['recordID'] = header['nextFree']
+    updatePalmFile(fileName, additions=[event])
     return event
 
-def changeAppointment(event):
-    return
+def changeAppointment(fileName, event):
+    """Replace the event of the datebook fileName with the same recordID"""
+    updatePalmFile(fileName, changes={event['recordID']: event})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,448 @@
+# coding: utf-8
+
+import Queue
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import palmFile
+
+from palm2vcal import compression
+from palm2vcal import converter
+
+
+class BufferedOutput(object):
+    """Output file of a sink, written in large blocks.
+
+    Attributes:
+        path: str, name of the file; compression follows its extension
+        buffer_size: int, number of bytes kept before writing them
+    """
+
+    def __init__(self, path, buffer_size=64 * 1024):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._chunks = []
+        self._size = 0
+        self._file = compression.open_file(path + '.tmp', 'wb',
+            compression.codec_from_name(path))
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self._file.write(''.join(self._chunks))
+        self._chunks = []
+        self._size = 0
+
+    def close(self):
+        """Write what is left, and move the file in place."""
+        self.flush()
+        self._file.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def discard(self):
+        """Drop the file, keeping any previous one."""
+        self._file.close()
+        os.remove(self.path + '.tmp')
+
+
+class BackendSink(object):
+    """Write records to a file through one of converter.BACKENDS.
+
+    Attributes:
+        path: str, the target file
+        output_format: str, name of the backend
+    """
+
+    def __init__(self, conv, path, output_format='ics'):
+        self.converter = conv
+        self.path = path
+        self.output_format = output_format
+        self.output = None
+        self.backend = converter.BACKENDS[output_format](conv)
+
+    def start(self, header):
+        self.output = BufferedOutput(self.path)
+        self.backend.start(self.output, header)
+
+    def write(self, e, uid=None):
+        self.backend.write(self.output, e, uid)
+
+    def finish(self):
+        self.backend.finish(self.output)
+        self.output.close()
+
+    def abort(self):
+        if self.output is not None:
+            self.output.discard()
+
+
+class CategorySink(object):
+    """Write the records of each category to their own file of a directory.
+
+    Attributes:
+        dst_dir: str, the target directory
+        output_format: str, name of the backend of the files
+    """
+
+    def __init__(self, conv, dst_dir, output_format='ics'):
+        self.converter = conv
+        self.dst_dir = dst_dir
+        self.output_format = output_format
+        self.header = None
+        self.sinks = {}
+
+    def start(self, header):
+        if not os.path.isdir(self.dst_dir):
+            os.makedirs(self.dst_dir)
+        self.header = header
+
+    def sink(self, category):
+        """Find the sink of a category, starting it on its first record."""
+        sink = self.sinks.get(category)
+        if sink is None:
+            name = self.converter.categories.get(category, u'Unfiled')
+            slug = re.sub(r'[^\w.-]+', '_', name.encode('utf-8')).strip('._') or 'category'
+            path = os.path.join(self.dst_dir, '%s-%d.%s' % (slug, category, self.output_format))
+            sink = self.sinks[category] = BackendSink(self.converter, path, self.output_format)
+            sink.start(self.header)
+        return sink
+
+    def write(self, e, uid=None):
+        self.sink(e['category']).write(e, uid)
+
+    def finish(self):
+        for category in sorted(self.sinks):
+            self.sinks[category].finish()
+
+    def abort(self):
+        for sink in self.sinks.values():
+            sink.abort()
+
+
+class StatsSink(object):
+    """Write a JSON report counting records by year, category and kind.
+
+    Attributes:
+        path: str, the target file
+        stats: dict, the report
+    """
+
+    def __init__(self, conv, path):
+        self.converter = conv
+        self.path = path
+        self.stats = None
+
+    def start(self, header):
+        self.stats = {'records': 0, 'years': {}, 'categories': {},
+            'repeating': 0, 'untimed': 0}
+
+    def count(self, group, key):
+        self.stats[group][key] = self.stats[group].get(key, 0) + 1
+
+    def write(self, e, uid=None):
+        self.stats['records'] += 1
+        self.count('categories', self.converter.categories.get(e['category'], u'Unfiled'))
+        if 'startTime' in e:
+            self.count('years', str(self.converter.mkdate(e['startTime']).year))
+            self.stats['repeating'] += bool(e['repeatEvent']['repeatEventFlag'])
+            self.stats['untimed'] += bool(e['untimed'])
+
+    def finish(self):
+        output = BufferedOutput(self.path)
+        output.write(json.dumps(self.stats, indent=2, sort_keys=True) + '\n')
+        output.close()
+
+    def abort(self):
+        pass
+
+
+# Sink kinds besides converter.BACKENDS, by name
+SINKS = {
+    'category': CategorySink,
+    'stats': StatsSink,
+}
+
+
+def parse_sink(spec):
+    """Split a KIND:PATH sink specification.
+
+    KIND is a name of converter.BACKENDS, writing a single file, or one of
+    SINKS.
+
+    Raises:
+        ValueError: spec is not a valid specification
+    """
+    kind, sep, path = spec.partition(':')
+    if not sep or not path:
+        raise ValueError("Sinks are given as KIND:PATH, not %r" % spec)
+    if kind not in converter.BACKENDS and kind not in SINKS:
+        raise ValueError("Unknown sink kind %r" % kind)
+    return kind, path
+
+
+def make_sink(conv, spec):
+    """Build a sink from a KIND:PATH specification, see parse_sink."""
+    kind, path = parse_sink(spec)
+    if kind in converter.BACKENDS:
+        return BackendSink(conv, path, kind)
+    return SINKS[kind](conv, path)
+
+
+class FanOut(object):
+    """Feed the records of one source file to several sinks.
+
+    The source is streamed and each record decoded once, then handed to
+    every sink in turn with its UID; adding a sink only adds its own
+    serialization. UIDs are built once per record, so records without an
+    ID get the same UID in every output, and the same as in a standalone
+    conversion.
+    Sinks buffer their output, and write it to a temporary file which is
+    only moved in place once complete.
+
+    A sink failing on a record is aborted (its output is dropped, any
+    previous one is kept) and skipped from then on, without stopping the
+    others.
+
+    A sink has start(header), write(record, uid), finish() and abort()
+    methods; see BackendSink, CategorySink and StatsSink.
+
+    Attributes:
+        converter: Palm2vCalConverter decoding records, shared by sinks
+        sinks: dict mapping sink names to sinks
+        errors: dict mapping the names of failed sinks to their error
+    """
+
+    def __init__(self, conv):
+        self.converter = conv
+        self.sinks = {}
+        self.errors = {}
+
+    def add_sink(self, name, sink):
+        self.sinks[name] = sink
+
+    def _call(self, name, method, *args):
+        try:
+            getattr(self.sinks[name], method)(*args)
+        except Exception, e:
+            self.errors[name] = '%s: %s' % (e.__class__.__name__, e)
+            try:
+                self.sinks[name].abort()
+            except Exception:
+                pass
+            return False
+        return True
+
+    def run(self):
+        """Read the source file once, feeding every sink.
+
+        Returns:
+            dict mapping the names of failed sinks to their error
+        """
+        conv = self.converter
+        header, records = palmFile.iterPalmFileObject(conv.src_file, conv.record_filter)
+        conv.load_header(header)
+
+        active = [name for name in sorted(self.sinks) if self._call(name, 'start', header)]
+        for e in records:
+            if not conv.accept_record(e):
+                continue
+            conv.num_events += 1
+            uid = conv.make_uid(e)
+            active = [name for name in active if self._call(name, 'write', e, uid)]
+        for name in active:
+            self._call(name, 'finish')
+        return self.errors
+
+
+# Marks the end of the batches of a stage
+_END = object()
+
+
+class StageStats(object):
+    """Time spent by a stage of a PipelinedConversion.
+
+    Attributes:
+        name: str, the name of the stage
+        items: int, number of records the stage handled
+        starved: float, seconds spent waiting for input
+        blocked: float, seconds spent waiting for room in the next queue
+        elapsed: float, seconds between the start and the end of the stage
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def busy(self):
+        """Seconds spent working."""
+        return max(self.elapsed - self.starved - self.blocked, 0.0)
+
+    def utilization(self, elapsed):
+        """Share of elapsed seconds spent working."""
+        return self.busy / elapsed if elapsed else 0.0
+
+
+class PipelinedConversion(object):
+    """Convert a source file through three concurrent stages.
+
+    'parse' reads and decodes records, 'map' turns them into events (see
+    the map() method of converter.BACKENDS), 'write' serializes and
+    writes them. Each stage runs in its own thread and hands batches of
+    batch_size records to the next one through a queue holding at most
+    queue_size batches: a stage ahead of the next one waits for room, so
+    memory use stays bounded whatever the size of the source file.
+
+    Stages only overlap while waiting for I/O, such as reads from a slow
+    mount or writes to a slow target; the interpreter lock runs decoding,
+    mapping and serialization one at a time. The stage with the highest
+    utilization is the bottleneck.
+
+    A stage failing stops the others, and its error is raised by run().
+    Only the map stage calls the converter, so its sync_state, if any, is
+    updated one record at a time and in file order.
+
+    Attributes:
+        converter: Palm2vCalConverter reading the source file
+        dst_file: file object receiving the output
+        queue_size: int, maximum number of batches waiting between stages
+        batch_size: int, number of records per batch
+        stats: list of StageStats, one per stage, in pipeline order
+        elapsed: float, duration of the last run(), in seconds
+    """
+
+    STAGES = ('parse', 'map', 'write')
+
+    def __init__(self, conv, dst_file, queue_size=8, batch_size=256):
+        self.converter = conv
+        self.dst_file = dst_file
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stats = [StageStats(name) for name in self.STAGES]
+        self.elapsed = 0.0
+        self._error = None
+        self._aborted = threading.Event()
+
+    def _get(self, queue, stats):
+        start = time.time()
+        batch = queue.get()
+        stats.starved += time.time() - start
+        return batch
+
+    def _put(self, queue, batch, stats):
+        start = time.time()
+        queue.put(batch)
+        stats.blocked += time.time() - start
+
+    def _fail(self):
+        if self._error is None:
+            self._error = sys.exc_info()
+        self._aborted.set()
+
+    def _drain(self, queue):
+        """Consume the input of a failed stage, unblocking the previous one."""
+        while queue.get() is not _END:
+            pass
+
+    def _parse(self, records, output, stats):
+        conv = self.converter
+        start = time.time()
+        try:
+            batch = []
+            for e in records:
+                if self._aborted.is_set():
+                    break
+                if not conv.accept_record(e):
+                    continue
+                batch.append(e)
+                if len(batch) >= self.batch_size:
+                    stats.items += len(batch)
+                    self._put(output, batch, stats)
+                    batch = []
+            if batch and not self._aborted.is_set():
+                stats.items += len(batch)
+                self._put(output, batch, stats)
+        except Exception:
+            self._fail()
+        finally:
+            output.put(_END)
+            stats.elapsed = time.time() - start
+
+    def _map(self, backend, source, output, stats):
+        start = time.time()
+        try:
+            while True:
+                batch = self._get(source, stats)
+                if batch is _END:
+                    break
+                if not self._aborted.is_set():
+                    mapped = [backend.map(e) for e in batch]
+                    stats.items += len(mapped)
+                    self._put(output, mapped, stats)
+        except Exception:
+            self._fail()
+            self._drain(source)
+        finally:
+            output.put(_END)
+            stats.elapsed = time.time() - start
+
+    def _write(self, backend, source, stats):
+        start = time.time()
+        try:
+            while True:
+                batch = self._get(source, stats)
+                if batch is _END:
+                    break
+                if not self._aborted.is_set():
+                    self.dst_file.write(''.join([backend.serialize(item) for item in batch]))
+                    stats.items += len(batch)
+        except Exception:
+            self._fail()
+            self._drain(source)
+        finally:
+            stats.elapsed = time.time() - start
+
+    def run(self):
+        """Convert the whole source file.
+
+        Returns:
+            int, the number of converted events (or contacts)
+        """
+        conv = self.converter
+        start = time.time()
+        header, records = palmFile.iterPalmFileObject(conv.src_file, conv.record_filter)
+        conv.load_header(header)
+        backend = converter.BACKENDS[conv.output_format](conv)
+        backend.start(self.dst_file, header)
+
+        parsed = Queue.Queue(self.queue_size)
+        mapped = Queue.Queue(self.queue_size)
+        parse_stats, map_stats, write_stats = self.stats
+        threads = [
+            threading.Thread(target=self._parse, args=(records, parsed, parse_stats)),
+            threading.Thread(target=self._map, args=(backend, parsed, mapped, map_stats)),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._write(backend, mapped, write_stats)
+        for thread in threads:
+            thread.join()
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        backend.finish(self.dst_file)
+        conv.num_events = write_stats.items
+        self.elapsed = time.time() - start
+        return conv.num_events
@@ -0,0 +1,294 @@
+# coding: utf-8
+
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+
+import palmFile
+
+from palm2vcal import __version__
+from palm2vcal import compression
+from palm2vcal import converter
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def _open_temporary(path):
+    """Open a new file next to path, to be renamed to it once written.
+
+    Returns:
+        (file object, name) tuple
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+        dir=os.path.dirname(os.path.abspath(path)))
+    # mkstemp only lets the owner read the file
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0666 & ~umask)
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+def write_shard(job):
+    """Write one shard; runs in a worker process.
+
+    Records are read back from the source file at their offsets, so
+    workers only receive file names and integers.
+
+    Args:
+        job: (src_name, src_encoding, offsets, path, compress) tuple
+
+    Returns:
+        int, the number of events written
+    """
+    src_name, src_encoding, offsets, path, compress = job
+    src_file = compression.open_file(src_name, 'rb')
+    try:
+        conv = converter.Palm2vCalConverter(src_file, src_encoding=src_encoding)
+        header, records = palmFile.iterPalmFileObject(src_file)
+        conv.load_header(header)
+
+        def events():
+            for offset in offsets:
+                src_file.seek(offset)
+                yield conv.map_event(palmFile.readFRecord(src_file, palmFile.calendarEntryFields))
+
+        dst_file, tmp_path = _open_temporary(path)
+        if compress:
+            dst_file = compression.CompressedFile(dst_file, compress)
+        try:
+            conv.write_calendar(dst_file, events())
+        except:
+            dst_file.close()
+            os.remove(tmp_path)
+            raise
+        dst_file.close()
+        os.rename(tmp_path, path)
+    finally:
+        src_file.close()
+    return len(offsets)
+
+
+class ShardedExport(object):
+    """Export a .dba file as several .ics files.
+
+    Events are partitioned by year of their start, by category, or in
+    fixed-size chunks. A first pass records the offset and content hash
+    of each record; shards whose records did not change since the last
+    run (as recorded in the manifest) are not rewritten. The others are
+    written by their own writer, in parallel worker processes if jobs > 1,
+    from a decompressed copy of the source file if it is compressed.
+
+    Attributes:
+        src_name: str, path of the source .dba file
+        dst_dir: str, directory holding the shards and their manifest
+        shard_by: str, one of SHARD_KINDS
+        shard_size: int, number of events per shard when shard_by='count'
+        src_encoding: the encoding to use when reading text from the
+            source file
+        jobs: int, number of worker processes
+        compress: str, compression of the shards, one of
+            compression.CODECS, or None
+        written: list of the keys of rewritten shards
+        skipped: list of the keys of unchanged shards
+        removed: list of the keys of shards that no longer exist
+    """
+
+    SHARD_KINDS = ('year', 'category', 'count')
+
+    def __init__(self, src_name, dst_dir, shard_by='year', shard_size=1000,
+            src_encoding='cp1252', jobs=1, compress=None):
+        if shard_by not in self.SHARD_KINDS:
+            raise ValueError("Unknown shard kind %r" % shard_by)
+        self.src_name = src_name
+        self.dst_dir = dst_dir
+        self.shard_by = shard_by
+        self.shard_size = shard_size
+        self.src_encoding = src_encoding
+        self.jobs = jobs
+        self.compress = compress
+        self.converter = converter.Palm2vCalConverter(None, src_encoding=src_encoding)
+        self.written = []
+        self.skipped = []
+        self.removed = []
+
+    @property
+    def options(self):
+        """Options that change the contents of shards."""
+        return {
+            'version': __version__,
+            'shard_by': self.shard_by,
+            'shard_size': self.shard_size,
+            'encoding': self.src_encoding,
+            'compress': self.compress,
+        }
+
+    def shard_key(self, position, e):
+        """Key of the shard holding a palmFile event."""
+        if self.shard_by == 'year':
+            return u'%d' % self.converter.mkdate(e['startTime']).year
+        elif self.shard_by == 'category':
+            return self.converter.categories.get(e['category'], u'Unfiled')
+        else:
+            return u'%05d' % (position // self.shard_size)
+
+    def shard_name(self, key, taken):
+        """Build a file name for a new shard, unique among taken names."""
+        slug = re.sub(r'[^\w.-]+', '_', key.encode('utf-8')).strip('._') or 'shard'
+        extension = '.ics.%s' % self.compress if self.compress else '.ics'
+        name = slug + extension
+        suffix = 1
+        while name in taken:
+            suffix += 1
+            name = '%s-%d%s' % (slug, suffix, extension)
+        return name
+
+    def plan(self):
+        """Assign the records of the source file to shards.
+
+        Returns:
+            dict mapping shard keys to (offsets, digest) tuples
+        """
+        offsets = {}
+        digests = {}
+        src_file = compression.open_file(self.src_name, 'rb')
+        try:
+            header, records = palmFile.iterPalmFileObject(src_file)
+            if header['versionTag'] != "\x00\x01BD":
+                raise ValueError("Only datebooks can be sharded")
+            labels = palmFile.calendarEntryFields
+            if header['fieldCount'] != len(labels):
+                raise ValueError()
+            self.converter.load_header(header)
+
+            for position in xrange(header['numEntries'] / header['fieldCount']):
+                offset = src_file.tell()
+                e = palmFile.readFRecord(src_file, labels)
+                key = self.shard_key(position, e)
+                if key not in offsets:
+                    offsets[key] = []
+                    digests[key] = hashlib.sha1()
+                offsets[key].append(offset)
+                digests[key].update(palmFile.recordDigest(e))
+        finally:
+            src_file.close()
+
+        return dict((key, (offsets[key], digests[key].hexdigest())) for key in offsets)
+
+    def decompress_source(self):
+        """Decompress a compressed source file to a temporary file.
+
+        Shard writers read records back by offset, which would decompress
+        the source from its start for each shard.
+
+        Returns:
+            str, name of the decompressed copy, None if the source is plain
+        """
+        src_file = compression.open_file(self.src_name, 'rb')
+        try:
+            if not compression.is_compressed(src_file):
+                return None
+            fd, name = tempfile.mkstemp(suffix='.dba')
+            copy = os.fdopen(fd, 'wb')
+            try:
+                compression.copy_data(src_file, copy)
+            except:
+                copy.close()
+                os.remove(name)
+                raise
+            copy.close()
+            return name
+        finally:
+            src_file.close()
+
+    def manifest_path(self):
+        return os.path.join(self.dst_dir, MANIFEST_NAME)
+
+    def load_manifest(self):
+        """Load the manifest of a previous run, if any."""
+        try:
+            manifest_file = open(self.manifest_path(), 'rb')
+        except IOError:
+            return {}
+        try:
+            return json.load(manifest_file)
+        except ValueError:
+            return {}
+        finally:
+            manifest_file.close()
+
+    def remove_shard(self, shard):
+        path = os.path.join(self.dst_dir, shard['file'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write_manifest(self, shards):
+        path = self.manifest_path()
+        manifest_file, tmp_path = _open_temporary(path)
+        try:
+            json.dump({'options': self.options, 'shards': shards}, manifest_file,
+                indent=2, sort_keys=True)
+        finally:
+            manifest_file.close()
+        os.rename(tmp_path, path)
+
+    def export(self):
+        """Write modified shards and the manifest to dst_dir."""
+        if not os.path.isdir(self.dst_dir):
+            os.makedirs(self.dst_dir)
+
+        plan = self.plan()
+        manifest = self.load_manifest()
+        previous = manifest.get('shards', {})
+        if manifest.get('options') != self.options:
+            # Shards from other options must all be rebuilt
+            for key in previous:
+                self.remove_shard(previous[key])
+            previous = {}
+        taken = set(shard['file'] for shard in previous.values())
+        shards = {}
+        jobs = []
+
+        for key in sorted(plan):
+            offsets, digest = plan[key]
+            old = previous.get(key)
+            if old is not None:
+                name = old['file']
+            else:
+                name = self.shard_name(key, taken)
+                taken.add(name)
+            shards[key] = {'file': name, 'events': len(offsets), 'digest': digest}
+            path = os.path.join(self.dst_dir, name)
+
+            if old is not None and old['digest'] == digest and os.path.exists(path):
+                self.skipped.append(key)
+            else:
+                self.written.append(key)
+                jobs.append((offsets, path))
+
+        plain_name = self.decompress_source() if jobs else None
+        jobs = [(plain_name or self.src_name, self.src_encoding, offsets, path, self.compress)
+            for offsets, path in jobs]
+        try:
+            if self.jobs > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(min(self.jobs, len(jobs)))
+                try:
+                    pool.map(write_shard, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for job in jobs:
+                    write_shard(job)
+        finally:
+            if plain_name is not None:
+                os.remove(plain_name)
+
+        for key in sorted(set(previous) - set(plan)):
+            self.remove_shard(previous[key])
+            self.removed.append(key)
+
+        self.write_manifest(shards)
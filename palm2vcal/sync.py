@@ -0,0 +1,93 @@
+# coding: utf-8
+
+import datetime
+import json
+import os
+import time
+
+import pytz
+
+
+class SyncStateError(ValueError):
+    """Raised when a state file cannot be read back."""
+
+    def __init__(self, path, reason):
+        ValueError.__init__(self, "Invalid sync state file %r: %s" % (path, reason))
+        self.path = path
+
+
+class SyncState(object):
+    """Remember the content hash of each event from one run to the next.
+
+    Palm records hold no modification time; this state gives events a
+    SEQUENCE and LAST-MODIFIED that only change when the content hash of
+    their record does, so that re-importing unchanged events is a no-op
+    for calendar clients.
+
+    Attributes:
+        path: str, the JSON file holding the state
+        entries: dict mapping UIDs to [digest, sequence, last_modified]
+            lists, last_modified being a timestamp
+        seen: set of the UIDs updated during this run
+        now: int, timestamp used as LAST-MODIFIED for changed events
+    """
+
+    def __init__(self, path, now=None):
+        self.path = path
+        self.entries = {}
+        self.seen = set()
+        if now is None:
+            now = int(time.time())
+        self.now = now
+
+    def load(self):
+        """Load entries saved by a previous run, if any.
+
+        Raises:
+            SyncStateError: the file is truncated or corrupt
+        """
+        try:
+            state_file = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                entries = json.load(state_file)
+            except ValueError, e:
+                raise SyncStateError(self.path, e)
+        finally:
+            state_file.close()
+        if not isinstance(entries, dict) or not all(
+                isinstance(entry, list) and len(entry) == 3 for entry in entries.values()):
+            raise SyncStateError(self.path, "unexpected contents")
+        self.entries = entries
+
+    def save(self):
+        """Save the entries updated during this run.
+
+        Entries of events that were not seen are dropped.
+        """
+        entries = dict((uid, self.entries[uid]) for uid in self.seen)
+        state_file = open(self.path + '.tmp', 'wb')
+        try:
+            json.dump(entries, state_file, sort_keys=True)
+        finally:
+            state_file.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def update(self, uid, digest):
+        """Record the content hash of an event.
+
+        Returns:
+            (sequence, last_modified) tuple, last_modified being a UTC
+            datetime.datetime
+        """
+        entry = self.entries.get(uid)
+        if entry is None:
+            entry = [digest, 0, self.now]
+        elif entry[0] != digest:
+            entry = [digest, entry[1] + 1, self.now]
+        self.entries[uid] = entry
+        self.seen.add(uid)
+        last_modified = datetime.datetime.fromtimestamp(entry[2], pytz.utc)
+        return entry[1], last_modified
@@ -0,0 +1,283 @@
+# coding: utf-8
+
+import hashlib
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from palm2vcal import compression
+from palm2vcal import converter
+
+
+STATE_NAME = '.palm2vcal-watch.json'
+
+# Extensions of watched source files, compressed ones included
+SOURCE_EXTENSIONS = ('.dba', '.dat')
+
+
+def source_stats(src_dir):
+    """List the source files of a directory.
+
+    Uses scandir when available (the scandir package on Python 2), which
+    saves a stat() call per file on most platforms.
+
+    Returns:
+        dict mapping file names to (size, mtime) tuples
+    """
+    stats = {}
+    if scandir is not None:
+        for entry in scandir(src_dir):
+            if is_source(entry.name) and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_size, stat.st_mtime)
+    else:
+        for name in os.listdir(src_dir):
+            if is_source(name):
+                path = os.path.join(src_dir, name)
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    stats[name] = (stat.st_size, stat.st_mtime)
+    return stats
+
+
+def strip_compression(name):
+    codec = compression.codec_from_name(name)
+    if codec is not None:
+        return name[:-len(codec) - 1]
+    return name
+
+
+def is_source(name):
+    return strip_compression(name).lower().endswith(SOURCE_EXTENSIONS)
+
+
+def file_digest(path):
+    """Content hash of a file."""
+    digest = hashlib.sha1()
+    src_file = open(path, 'rb')
+    try:
+        while True:
+            data = src_file.read(compression.CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        src_file.close()
+    return digest.hexdigest()
+
+
+class DirectoryWatcher(object):
+    """Keep a directory of .ics files in sync with a directory of .dba files.
+
+    The source directory is polled; files whose size or mtime changed
+    since the last poll are only converted once they stopped changing for
+    settle seconds, so that files still being written are left alone.
+    A content hash then tells actual changes from mere touches.
+    Conversions run in a bounded pool of jobs threads, and outputs of
+    deleted sources are removed.
+
+    Sizes, mtimes and hashes are kept in a state file in dst_dir, so
+    that a restarted watcher only converts what changed meanwhile.
+
+    Attributes:
+        src_dir: str, the watched directory
+        dst_dir: str, the directory holding converted files
+        interval: float, seconds between two polls
+        settle: float, seconds a file must stay unchanged before being
+            converted
+        jobs: int, maximum number of concurrent conversions
+        options: dict of converter.convert() options
+        logfile: file object receiving progress messages, or None
+        entries: dict mapping source names to their state: a dict with
+            'size', 'mtime', 'digest' and 'output' items, and an 'error'
+            one when their last conversion failed
+    """
+
+    def __init__(self, src_dir, dst_dir, interval=5, settle=2, jobs=1,
+            options=None, logfile=None):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.interval = interval
+        self.settle = settle
+        self.jobs = jobs
+        self.options = dict(options or {})
+        self.logfile = logfile
+        self.entries = {}
+        self._changing = {}
+        self._pool = None
+
+    @property
+    def state_path(self):
+        return os.path.join(self.dst_dir, STATE_NAME)
+
+    def log(self, message):
+        if self.logfile is not None:
+            self.logfile.write(message + '\n')
+            self.logfile.flush()
+
+    def load(self):
+        """Load the state of a previous run, if any."""
+        try:
+            state_file = open(self.state_path, 'rb')
+        except IOError:
+            return
+        try:
+            state = json.load(state_file)
+        except ValueError:
+            state = {}
+        finally:
+            state_file.close()
+        if state.get('options') == self.options:
+            self.entries = state.get('entries', {})
+        else:
+            # Outputs of other options are all rebuilt
+            self.entries = dict((name, {'output': entry['output']})
+                for name, entry in state.get('entries', {}).items())
+
+    def save(self):
+        state_file = open(self.state_path + '.tmp', 'wb')
+        try:
+            json.dump({'options': self.options, 'entries': self.entries},
+                state_file, indent=2, sort_keys=True)
+        finally:
+            state_file.close()
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def output_name(self, name):
+        """Name of the converted file of a source file.
+
+        The whole source name is kept, so that a.dba, a.dat and a.dba.gz
+        are converted to a.dba.ics, a.dat.ics and a.dba.gz.ics rather
+        than all to a.ics.
+        """
+        extension = '.%s' % self.options.get('output_format', 'ics')
+        compress = self.options.get('compress')
+        if compress:
+            extension += '.' + compress
+        return name + extension
+
+    def settled(self, name, stat, now):
+        """Whether a changed source file stopped changing."""
+        if self._changing.get(name) != stat:
+            self._changing[name] = stat
+            if now - stat[1] >= self.settle:
+                # Already old enough on the first sight, e.g. at startup
+                return True
+            return False
+        return now - stat[1] >= self.settle
+
+    def convert(self, name):
+        """Convert a source file, through a temporary file.
+
+        Returns:
+            (name, error) tuple, error being None on success
+        """
+        src_path = os.path.join(self.src_dir, name)
+        dst_path = os.path.join(self.dst_dir, self.output_name(name))
+        tmp_path = dst_path + '.tmp'
+        try:
+            converter.convert(src_path, tmp_path, self.options)
+            os.rename(tmp_path, dst_path)
+        except Exception, e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return name, '%s: %s' % (e.__class__.__name__, e)
+        return name, None
+
+    def remove_output(self, entry):
+        path = os.path.join(self.dst_dir, entry['output'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def poll(self, now=None):
+        """Look for changes once, and convert changed files.
+
+        Returns:
+            (converted, removed) tuple of lists of source file names
+        """
+        if now is None:
+            now = time.time()
+        stats = source_stats(self.src_dir)
+        converted = []
+        removed = []
+        digests = {}
+        touched = False
+
+        for name in sorted(stats):
+            size, mtime = stats[name]
+            entry = self.entries.get(name, {})
+            if entry.get('size') == size and entry.get('mtime') == mtime:
+                self._changing.pop(name, None)
+                continue
+            if not self.settled(name, (size, mtime), now):
+                continue
+            self._changing.pop(name, None)
+
+            digest = file_digest(os.path.join(self.src_dir, name))
+            output = self.output_name(name)
+            if entry.get('digest') == digest and entry.get('output') == output:
+                # Touched, not modified
+                entry.update(size=size, mtime=mtime)
+                touched = True
+                continue
+            digests[name] = (size, mtime, digest)
+
+        if digests:
+            if self.jobs > 1 and len(digests) > 1:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.jobs)
+                results = self._pool.map(self.convert, sorted(digests))
+            else:
+                results = map(self.convert, sorted(digests))
+
+            for name, error in results:
+                size, mtime, digest = digests[name]
+                previous = self.entries.get(name)
+                output = self.output_name(name)
+                if previous is not None and previous.get('output') not in (None, output):
+                    self.remove_output(previous)
+                entry = {'size': size, 'mtime': mtime, 'digest': digest, 'output': output}
+                if error is None:
+                    converted.append(name)
+                    self.log("Converted %r to %r." % (name, output))
+                else:
+                    # Not retried before the file changes again
+                    entry['digest'] = None
+                    entry['error'] = error
+                    self.log("Failed to convert %r: %s" % (name, error))
+                self.entries[name] = entry
+
+        for name in sorted(set(self.entries) - set(stats)):
+            entry = self.entries.pop(name)
+            self.remove_output(entry)
+            removed.append(name)
+            self.log("Removed %r, its source is gone." % entry['output'])
+        for name in set(self._changing) - set(stats):
+            del self._changing[name]
+
+        if digests or removed or touched:
+            self.save()
+        return converted, removed
+
+    def run(self):
+        """Poll forever, until interrupted."""
+        if not os.path.isdir(self.dst_dir):
+            os.makedirs(self.dst_dir)
+        self.load()
+        try:
+            while True:
+                self.poll()
+                time.sleep(self.interval)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
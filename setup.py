@@ -37,6 +37,7 @@ setup(
     license='GPL',
     requires=[
         'icalendar',
+        'pytz',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
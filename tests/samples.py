@@ -0,0 +1,176 @@
+# coding: utf-8
+"""Build synthetic Palm files for the tests."""
+
+import struct
+
+from palm2vcal import palmFile
+
+
+DATEBOOK_TAG = '\x00\x01BD'
+ADDRESS_BOOK_TAG = '\x00\x01BA'
+
+# Field types of datebook records, in calendarEntryFields order
+DATEBOOK_SCHEMA = (1, 1, 1, 3, 3, 5, 1, 5, 6, 6, 1, 6, 1, 1, 8)
+
+# Field types of address book records, in addressEntryFields order
+ADDRESS_BOOK_SCHEMA = (1, 1, 1, 5, 5, 5, 5) + (1, 5) * 5 + (5,) * 6 + (6, 1) + (5,) * 4 + (1,)
+
+START = 1300000000
+HOUR = 3600
+DAY = 24 * HOUR
+
+NO_REPEAT = {'dateExceptionCount': 0, 'repeatEventFlag': 0}
+
+
+def daily(interval=1, end_date=None, exceptions=()):
+    """Repeat rule of an event happening every interval days."""
+    return {'dateExceptionCount': len(exceptions), 'dateExceptions': list(exceptions),
+        'repeatEventFlag': 1, 'brand': 1, 'interval': interval,
+        'endDate': end_date if end_date is not None else 0xFFFFFFFF,
+        'firstDayOfWeek': 0, 'brandDayIndex': 0}
+
+
+def weekly(days_mask, end_date=None, exceptions=()):
+    """Repeat rule of an event happening every week on days_mask, Sunday first."""
+    return {'dateExceptionCount': len(exceptions), 'dateExceptions': list(exceptions),
+        'repeatEventFlag': 0xFFFF,
+        'classRecord': {'constant': 1, 'nameLength': 11, 'name': 'CDayName123'},
+        'brand': 2, 'interval': 1,
+        'endDate': end_date if end_date is not None else 0xFFFFFFFF,
+        'firstDayOfWeek': 0, 'brandDayIndex': 0, 'brandDaysMask': chr(days_mask)}
+
+
+def monthly(day, interval=1, end_date=None, exceptions=()):
+    """Repeat rule of an event happening every interval months on a day of the month."""
+    return {'dateExceptionCount': len(exceptions), 'dateExceptions': list(exceptions),
+        'repeatEventFlag': 1, 'brand': 4, 'interval': interval,
+        'endDate': end_date if end_date is not None else 0xFFFFFFFF,
+        'firstDayOfWeek': 0, 'brandDayNumber': day}
+
+
+def yearly(month, day, interval=1, end_date=None, exceptions=()):
+    """Repeat rule of an event happening every interval years on a date, month from 0."""
+    return dict(monthly(day, interval, end_date, exceptions), brand=5, brandMonthIndex=month)
+
+
+def event(record_id, start=START, duration=HOUR, text=None, note='', category=0,
+        untimed=False, repeat=NO_REPEAT):
+    """A datebook record, as readPalmFile returns them."""
+    return {
+        'recordID': record_id, 'status': 0, 'position': record_id,
+        'startTime': start, 'endTime': start + duration,
+        'text': text if text is not None else 'Event %d' % record_id,
+        'duration': duration // 60, 'note': note, 'untimed': untimed, 'private': False,
+        'category': category, 'alarmSet': False, 'alarmAdvUnits': 0, 'alarmAdvType': 0,
+        'repeatEvent': dict(repeat),
+    }
+
+
+def datebook(events, categories=('Work', 'Home'), file_name='C:\\datebook.dat', next_free=None):
+    """The header of a datebook holding events."""
+    if next_free is None:
+        next_free = max([e['recordID'] for e in events] or [0]) + 1
+    return {
+        'versionTag': DATEBOOK_TAG,
+        'fileName': file_name, 'tableString': '', 'nextFree': next_free,
+        'categoryCount': len(categories),
+        'categoryList': [{'index': i + 1, 'id': i + 1, 'dirtyFlag': 0,
+            'longName': name, 'shortName': name[:4]} for i, name in enumerate(categories)],
+        'resourceID': 0x36, 'fieldsPerRow': len(DATEBOOK_SCHEMA), 'recIDPos': 0,
+        'recStatus': 1, 'placementPos': 2, 'fieldCount': len(DATEBOOK_SCHEMA),
+        'fieldEntry': [{'fieldEntryType': t} for t in DATEBOOK_SCHEMA],
+        'numEntries': len(events) * len(DATEBOOK_SCHEMA),
+        'datebookList': list(events),
+    }
+
+
+def write_datebook(path, events, **kwargs):
+    """Write a datebook file holding events."""
+    header = datebook(events, **kwargs)
+    f = open(path, 'wb')
+    try:
+        f.write(DATEBOOK_TAG)
+        palmFile.writeRecords(f, palmFile.calendarHeaderDef[1:], [header])
+    finally:
+        f.close()
+    return header
+
+
+def contact(record_id, last_name='', first_name='', company='', phones=(), category=0):
+    """An address book record, as readPalmFile returns them."""
+    e = {
+        'recordID': record_id, 'status': 0, 'position': record_id,
+        'lastName': last_name, 'firstName': first_name, 'title': '', 'companyName': company,
+        'address': '', 'city': '', 'state': '', 'zip': '', 'country': '', 'note': '',
+        'private': False, 'category': category,
+        'custom1Text': '', 'custom2Text': '', 'custom3Text': '', 'custom4Text': '',
+        'displayPhone': 0,
+    }
+    for i in range(5):
+        e['phone%dLabelID' % (i + 1)] = i
+        e['phone%dText' % (i + 1)] = phones[i] if i < len(phones) else ''
+    return e
+
+
+def address_book(contacts, categories=('Business', 'Personal'), file_name='C:\\address.dat'):
+    """The header of an address book holding contacts."""
+    fields = [{'fieldEntryType': t} for t in ADDRESS_BOOK_SCHEMA]
+    return {
+        'versionTag': ADDRESS_BOOK_TAG,
+        'fileName': file_name, 'tableString': '',
+        'nextFree': max([e['recordID'] for e in contacts] or [0]) + 1,
+        'categoryCount': len(categories),
+        'categoryList': [{'index': i + 1, 'id': i + 1, 'dirtyFlag': 0,
+            'longName': name, 'shortName': name[:4]} for i, name in enumerate(categories)],
+        'resourceID': 0x36, 'fieldsPerRow': len(ADDRESS_BOOK_SCHEMA), 'recIDPos': 0,
+        'recStatus': 1, 'placementPos': 2, 'fieldCount': len(ADDRESS_BOOK_SCHEMA),
+        # writeRecords looks frecord types up as fieldEntry
+        'fieldEntryList': fields, 'fieldEntry': fields,
+        'numEntries': len(contacts) * len(ADDRESS_BOOK_SCHEMA),
+        'addresses': list(contacts),
+    }
+
+
+def write_address_book(path, contacts, **kwargs):
+    """Write an address book file holding contacts."""
+    header = address_book(contacts, **kwargs)
+    f = open(path, 'wb')
+    try:
+        f.write(ADDRESS_BOOK_TAG)
+        palmFile.writeRecords(f, palmFile.addressHeaderDef[1:], [header])
+    finally:
+        f.close()
+    return header
+
+
+def write_large_datebook(path, count, variants=64, record_ids=True):
+    """Write a datebook of count records, quickly.
+
+    Records cycle through a few encoded variants, so that large files do
+    not cost a call to the encoder per record; they share their
+    recordIDs. Without record_ids, records have a recordID of 0, and
+    times shifted by their position so that no two of them are alike.
+    """
+    events = []
+    for i in xrange(variants):
+        repeat = (NO_REPEAT, daily(2, START + 30 * DAY), weekly(2 | 8, START + 60 * DAY))[i % 3]
+        events.append(event(i + 1 if record_ids else 0, START + i * 7919, text='Event %d caf\xe9' % i,
+            note='note %d' % i if i % 2 else '', category=i % 3, repeat=repeat))
+    header = datebook([], next_free=variants + 1)
+    header['numEntries'] = count * len(DATEBOOK_SCHEMA)
+    encoded = [palmFile.encodeFRecord(header['fieldEntry'], palmFile.calendarEntryFields, e)
+        for e in events]
+
+    f = open(path, 'wb')
+    try:
+        f.write(DATEBOOK_TAG)
+        palmFile.writeRecords(f, palmFile.calendarHeaderDef[1:], [header])
+        for i in xrange(count):
+            data = encoded[i % variants]
+            if not record_ids:
+                # startTime and endTime follow recordID, status and position
+                start, end = struct.unpack('<4xL4xL', data[24:40])
+                data = data[:24] + struct.pack('<LLLL', 3, start + i, 3, end + i) + data[40:]
+            f.write(data)
+    finally:
+        f.close()
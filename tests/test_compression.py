@@ -0,0 +1,154 @@
+# coding: utf-8
+
+import bz2
+import cStringIO
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import zlib
+
+import icalendar
+
+from palm2vcal import compression
+from palm2vcal import converter
+from palm2vcal import merge
+from palm2vcal import palmFile
+
+from tests import samples
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'bin', 'palm2vcal')
+
+
+def gzipped(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+        samples.write_datebook(self.path, [samples.event(i + 1, note='note %d ' % i * 50)
+            for i in range(20)])
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def texts(self, file_obj):
+        header, records = palmFile.iterPalmFileObject(file_obj)
+        return [e['text'] for e in records]
+
+    def test_detect(self):
+        self.assertEqual('gz', compression.detect(gzipped('data')))
+        self.assertEqual('bz2', compression.detect(bz2.compress('data')))
+        self.assertEqual(None, compression.detect(self.data))
+        self.assertEqual('xz', compression.codec_from_name('a.ics.xz'))
+        self.assertEqual(None, compression.codec_from_name('a.ics'))
+
+    def test_round_trip(self):
+        codecs = ['gz', 'bz2']
+        if compression.lzma is not None:
+            codecs.append('xz')
+        for codec in codecs:
+            path = os.path.join(self.tmp_dir, 'datebook.dba.' + codec)
+            dst_file = compression.open_file(path, 'wb')
+            dst_file.write(self.data)
+            dst_file.close()
+            with open(path, 'rb') as f:
+                self.assertEqual(codec, compression.detect(f.read(compression.PEEK_SIZE)))
+            src_file = compression.open_file(path, 'rb')
+            try:
+                self.assertEqual(self.data, src_file.read())
+                src_file.seek(10)
+                self.assertEqual(self.data[10:20], src_file.read(10))
+            finally:
+                src_file.close()
+
+    def test_concatenated_streams(self):
+        middle = len(self.data) // 2
+        path = self.write('datebook.dba.gz', gzipped(self.data[:middle]) + gzipped(self.data[middle:]))
+        src_file = compression.open_file(path, 'rb')
+        try:
+            self.assertEqual(20, len(self.texts(src_file)))
+        finally:
+            src_file.close()
+
+    def test_pipe_input(self):
+        for data in (self.data, gzipped(self.data)):
+            read_fd, write_fd = os.pipe()
+            writer = threading.Thread(target=self.feed, args=(write_fd, data))
+            writer.start()
+            src_file = os.fdopen(read_fd, 'rb')
+            try:
+                self.assertEqual(20, len(self.texts(src_file)))
+            finally:
+                src_file.close()
+                writer.join()
+
+    def feed(self, fd, data):
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+    def test_compressed_output(self):
+        dst = os.path.join(self.tmp_dir, 'datebook.ics.gz')
+        self.assertEqual(20, converter.convert(self.path, dst))
+        plain = cStringIO.StringIO()
+        converter.convert(self.path, plain)
+        f = gzip.open(dst, 'rb')
+        try:
+            self.assertEqual(plain.getvalue(), f.read())
+        finally:
+            f.close()
+
+    def test_corrupt_stream(self):
+        data = gzipped(self.data)
+        path = self.write('datebook.dba.gz', data[:100] + '\xff' * 50 + data[150:])
+        with self.assertRaises(palmFile.PalmFileError) as context:
+            palmFile.validatePalmFile(path)
+        self.assertIn('Corrupt gz stream', str(context.exception))
+
+        process = subprocess.Popen([sys.executable, SCRIPT, '--check', path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=ROOT))
+        out, err = process.communicate()
+        self.assertEqual(1, process.returncode)
+        self.assertIn('Corrupt gz stream', err)
+        self.assertIn('offset', err)
+
+    def test_merge_unsorted_compressed_source(self):
+        samples.write_datebook(self.path, [samples.event(i + 1, samples.START + (i * 7) % 20 * samples.HOUR)
+            for i in range(20)])
+        with open(self.path, 'rb') as f:
+            path = self.write('datebook.dba.gz', gzipped(f.read()))
+
+        results = []
+        for name in (self.path, path):
+            src_file = compression.open_file(name, 'rb')
+            try:
+                dst_file = cStringIO.StringIO()
+                merge.DatebookMerge([src_file]).export(dst_file)
+            finally:
+                src_file.close()
+            events = icalendar.Calendar.from_ical(dst_file.getvalue()).walk('VEVENT')
+            results.append([(unicode(e['SUMMARY']), e['DTSTART'].dt) for e in events])
+        self.assertEqual(20, len(results[0]))
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# coding: utf-8
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from palm2vcal import contacts
+
+from tests import samples
+
+
+class AddressIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'address.dat')
+        self.contacts = [
+            samples.contact(1, 'Smith', 'John', phones=['+1 (555) 010-2030', '555 0199']),
+            samples.contact(2, 'Smithers', 'Waylon', 'ACME Widgets', phones=['555-0100']),
+            samples.contact(3, 'M\xfcller', 'Zo\xeb', category=2),
+            samples.contact(4, company='Widget Works', phones=['+44 20 7946 0000']),
+        ]
+        samples.write_address_book(self.path, self.contacts)
+
+        # Count the indexes built from the address book, rather than loaded
+        self.built = []
+        self.from_file = contacts.AddressIndex.__dict__['from_file']
+        from_file = self.from_file.__func__
+
+        def counting_from_file(cls, path, src_encoding='cp1252'):
+            self.built.append(src_encoding)
+            return from_file(cls, path, src_encoding)
+        contacts.AddressIndex.from_file = classmethod(counting_from_file)
+
+    def tearDown(self):
+        contacts.AddressIndex.from_file = self.from_file
+        shutil.rmtree(self.tmp_dir)
+
+    def ids(self, found):
+        return [contact['recordID'] for contact in found]
+
+    def test_name_prefixes(self):
+        index = contacts.AddressIndex.from_file(self.path)
+        self.assertEqual([1, 2], self.ids(index.by_name(u'smith')))
+        self.assertEqual([2], self.ids(index.by_name(u'SMITHE')))
+        self.assertEqual([1], self.ids(index.by_name(u'john sm')))
+        self.assertEqual([1], self.ids(index.by_name(u'smith john')))
+        self.assertEqual([1], self.ids(index.by_name(u'smith', limit=1)))
+        self.assertEqual([], self.ids(index.by_name(u'jones')))
+        self.assertEqual([], self.ids(index.by_name(u' - ')))
+
+    def test_word_prefixes(self):
+        index = contacts.AddressIndex.from_file(self.path)
+        # Company names are found from any of their words; contacts come
+        # in the order of their matching keys, 'widget works' first
+        self.assertEqual([4, 2], self.ids(index.by_name(u'widg')))
+        self.assertEqual([4], self.ids(index.by_name(u'works')))
+        self.assertEqual([2], self.ids(index.by_name(u'acme widgets')))
+        self.assertEqual([2], self.ids(index.by_name(u'waylon')))
+
+    def test_phone_prefixes(self):
+        index = contacts.AddressIndex.from_file(self.path)
+        self.assertEqual([1], self.ids(index.by_phone(u'1-555')))
+        self.assertEqual([2, 1], self.ids(index.by_phone(u'555 01')))
+        self.assertEqual([1], self.ids(index.by_phone(u'555 019')))
+        self.assertEqual([4], self.ids(index.by_phone(u'+44 (20)')))
+        self.assertEqual([], self.ids(index.by_phone(u'556')))
+        self.assertEqual([], self.ids(index.by_phone(u'()')))
+
+    def test_search(self):
+        index = contacts.AddressIndex.from_file(self.path)
+        self.assertEqual([2], self.ids(index.search(u'555-0100')))
+        self.assertEqual([4, 2], self.ids(index.search(u'Widg')))
+
+    def test_accent_folding(self):
+        index = contacts.AddressIndex.from_file(self.path)
+        self.assertEqual([3], self.ids(index.by_name(u'muller')))
+        self.assertEqual([3], self.ids(index.by_name(u'M\xfcll')))
+        self.assertEqual([3], self.ids(index.by_name(u'zoe m')))
+        found = index.by_name(u'ZOE')
+        self.assertEqual(u'Zo\xeb', found[0]['firstName'])
+        self.assertEqual(u'Personal', found[0]['category'])
+
+    def test_saved_index_is_reused(self):
+        index = contacts.AddressIndex.for_file(self.path)
+        self.assertEqual(['cp1252'], self.built)
+        self.assertTrue(os.path.exists(contacts.index_path(self.path)))
+        self.assertFalse(os.path.exists(contacts.index_path(self.path) + '.tmp'))
+
+        loaded = contacts.AddressIndex.for_file(self.path)
+        self.assertEqual(['cp1252'], self.built)
+        self.assertEqual(index.name_keys, loaded.name_keys)
+        self.assertEqual(index.phone_keys, loaded.phone_keys)
+        self.assertEqual([3], self.ids(loaded.by_name(u'muller')))
+        self.assertEqual([2], self.ids(loaded.by_phone(u'5550100')))
+
+    def test_saved_index_is_rebuilt_when_size_changes(self):
+        contacts.AddressIndex.for_file(self.path)
+        samples.write_address_book(self.path, self.contacts + [samples.contact(5, 'Jones')])
+        index = contacts.AddressIndex.for_file(self.path)
+        self.assertEqual(['cp1252', 'cp1252'], self.built)
+        self.assertEqual([5], self.ids(index.by_name(u'jones')))
+        # The rebuilt index is saved in turn
+        contacts.AddressIndex.for_file(self.path)
+        self.assertEqual(2, len(self.built))
+
+    def test_saved_index_is_rebuilt_when_mtime_changes(self):
+        contacts.AddressIndex.for_file(self.path)
+        # Same size, other contents
+        self.contacts[0]['lastName'] = 'Jonas'
+        samples.write_address_book(self.path, self.contacts)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        index = contacts.AddressIndex.for_file(self.path)
+        self.assertEqual(2, len(self.built))
+        self.assertEqual([1], self.ids(index.by_name(u'jonas')))
+
+    def test_saved_index_is_rebuilt_when_encoding_changes(self):
+        samples.write_address_book(self.path, [samples.contact(1, 'M\xc3\xbcller')])
+        index = contacts.AddressIndex.for_file(self.path)
+        self.assertEqual([], self.ids(index.by_name(u'muller')))
+
+        index = contacts.AddressIndex.for_file(self.path, src_encoding='utf-8')
+        self.assertEqual(['cp1252', 'utf-8'], self.built)
+        self.assertEqual([1], self.ids(index.by_name(u'muller')))
+        with open(contacts.index_path(self.path), 'rb') as index_file:
+            self.assertEqual('utf-8', json.load(index_file)['encoding'])
+
+        contacts.AddressIndex.for_file(self.path, src_encoding='utf-8')
+        self.assertEqual(2, len(self.built))
+
+    def test_unreadable_saved_index_is_rebuilt(self):
+        with open(contacts.index_path(self.path), 'wb') as index_file:
+            index_file.write('{"version": ')
+        index = contacts.AddressIndex.for_file(self.path)
+        self.assertEqual(['cp1252'], self.built)
+        self.assertEqual([1, 2], self.ids(index.by_name(u'smith')))
+
+    def test_not_an_address_book(self):
+        samples.write_datebook(self.path, [samples.event(1)])
+        self.assertRaises(ValueError, contacts.AddressIndex.from_file, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
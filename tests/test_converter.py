@@ -0,0 +1,210 @@
+# coding: utf-8
+
+import cStringIO
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import icalendar
+
+from palm2vcal import converter
+from palm2vcal import palmFile
+
+from tests import samples
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'bin', 'palm2vcal')
+
+
+class SelectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, **options):
+        dst_file = cStringIO.StringIO()
+        with open(self.path, 'rb') as src_file:
+            converter.convert(src_file, dst_file, options)
+        calendar = icalendar.Calendar.from_ical(dst_file.getvalue())
+        return sorted(unicode(e['SUMMARY']) for e in calendar.walk('VEVENT'))
+
+    def test_since_keeps_events_in_progress(self):
+        since = samples.START + samples.DAY
+        samples.write_datebook(self.path, [
+            samples.event(1, since - samples.DAY, text='Ended'),
+            samples.event(2, since - samples.HOUR, 2 * samples.HOUR, text='In progress'),
+            samples.event(3, since, text='Started'),
+        ])
+        self.assertEqual([u'In progress', u'Started'], self.convert(since=since))
+
+    def test_until(self):
+        until = samples.START + samples.DAY
+        samples.write_datebook(self.path, [
+            samples.event(1, until - samples.HOUR, 2 * samples.HOUR, text='Before'),
+            samples.event(2, until, text='At'),
+            samples.event(3, until - 2 * samples.DAY, text='Repeating', repeat=samples.daily()),
+        ])
+        self.assertEqual([u'Before', u'Repeating'], self.convert(until=until))
+
+    def test_category(self):
+        samples.write_datebook(self.path, [
+            samples.event(1, text='Work', category=1),
+            samples.event(2, text='Home', category=2),
+            samples.event(3, text='Unfiled'),
+        ], categories=('Work', 'Home', 'Caf\xe9'))
+        self.assertEqual([u'Work'], self.convert(categories=['Work']))
+        self.assertEqual([u'Home', u'Work'], self.convert(categories=[u'Home', 'Work']))
+        self.assertEqual([], self.convert(categories=['Caf\xc3\xa9']))
+
+    def test_only_repeating(self):
+        samples.write_datebook(self.path, [
+            samples.event(1, text='Single'),
+            samples.event(2, text='Daily', repeat=samples.daily()),
+            samples.event(3, text='Weekly', repeat=samples.weekly(2)),
+        ])
+        self.assertEqual([u'Daily', u'Weekly'], self.convert(only_repeating=True))
+
+    def test_rejected_records_are_not_decoded(self):
+        samples.write_datebook(self.path, [
+            samples.event(1, text='Caf\xe9', category=2),
+            samples.event(2, text='Work', category=1),
+        ])
+        # Not UTF-8: converting the first record fails
+        self.assertRaises(UnicodeDecodeError, self.convert, src_encoding='utf-8')
+        self.assertEqual([u'Work'], self.convert(src_encoding='utf-8', categories=['Work']))
+
+        decoded = []
+        original = palmFile.readField
+        def readField(f, fieldType):
+            value = original(f, fieldType)
+            decoded.append(value)
+            return value
+        palmFile.readField = readField
+        try:
+            self.assertEqual([u'Work'], self.convert(categories=['Work']))
+        finally:
+            palmFile.readField = original
+        self.assertIn('Work', decoded)
+        self.assertNotIn('Caf\xe9', decoded)
+
+    def test_filtered_errors_locate_records(self):
+        samples.write_datebook(self.path, [samples.event(1), samples.event(2, note='n' * 1000)])
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-600])
+        with self.assertRaises(palmFile.PalmFileError) as expected:
+            palmFile.validatePalmFile(self.path)
+
+        with open(self.path, 'rb') as f:
+            header, records = palmFile.iterPalmFileObject(f, lambda fields, header: True)
+            with self.assertRaises(palmFile.PalmFileError) as context:
+                list(records)
+        self.assertEqual(1, context.exception.record)
+        self.assertEqual(expected.exception.offset, context.exception.offset)
+
+    def test_selection_rejected_by_other_modes(self):
+        samples.write_datebook(self.path, [samples.event(1)])
+        for mode in (['--merge', self.path], ['--sqlite', os.path.join(self.tmp_dir, 'db'), self.path],
+                ['--diff', self.path, self.path], ['--shard-by', 'year', self.path, self.tmp_dir]):
+            process = subprocess.Popen([sys.executable, SCRIPT, '--since=2011-01-01'] + mode,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=ROOT))
+            out, err = process.communicate()
+            self.assertEqual(2, process.returncode, mode)
+            self.assertIn('cannot be combined', err)
+
+    def test_output_options_rejected_by_other_modes(self):
+        samples.write_datebook(self.path, [samples.event(1)])
+        for options, mode in ((['--format=jsonl'], ['--merge', self.path]),
+                (['--sync-state', os.path.join(self.tmp_dir, 'state')], ['--shard-by', 'year', self.path, self.tmp_dir]),
+                (['--uid-namespace', 'home'], ['--sqlite', os.path.join(self.tmp_dir, 'db'), self.path]),
+                (['--format=jsonl'], ['--diff', self.path, self.path])):
+            process = subprocess.Popen([sys.executable, SCRIPT] + options + mode,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=ROOT))
+            out, err = process.communicate()
+            self.assertEqual(2, process.returncode, mode)
+            self.assertIn('%s cannot be combined with %s' % (options[0].split('=')[0], mode[0]), err)
+
+
+class JsonLinesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_map_json(self):
+        samples.write_datebook(self.path, [
+            samples.event(1, text='Caf\xe9', category=1, repeat=samples.weekly(2 | 8)),
+            samples.event(2, untimed=True),
+        ])
+        dst_file = cStringIO.StringIO()
+        with open(self.path, 'rb') as src_file:
+            converter.convert(src_file, dst_file, {'output_format': 'jsonl'})
+        first, second = [json.loads(line) for line in dst_file.getvalue().splitlines()]
+
+        self.assertEqual(u'Caf\xe9', first['text'])
+        self.assertEqual(u'Work', first['category'])
+        self.assertEqual('event', first['type'])
+        self.assertEqual(datetime.datetime.fromtimestamp(samples.START).isoformat(), first['startTime'])
+        self.assertEqual(datetime.datetime.fromtimestamp(samples.START + samples.HOUR).isoformat(),
+            first['endTime'])
+        self.assertEqual(2 | 8, first['repeatEvent']['brandDaysMask'])
+        self.assertEqual(2, first['repeatEvent']['brand'])
+        self.assertTrue(first['uid'].startswith('1-'))
+
+        self.assertEqual(None, second['category'])
+        self.assertEqual(datetime.date.fromtimestamp(samples.START).isoformat(), second['startTime'])
+
+
+class ConvertManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_thread_pool(self):
+        jobs = []
+        for i in range(6):
+            src = os.path.join(self.tmp_dir, 'datebook-%d.dba' % i)
+            samples.write_datebook(src, [samples.event(j + 1, text='Event %d caf\xe9' % j,
+                note='n' * j, category=j % 3, repeat=samples.daily() if j % 2 else samples.NO_REPEAT)
+                for j in range(50 * i)])
+            options = {'output_format': 'jsonl'} if i % 2 else {'src_encoding': 'latin1'}
+            jobs.append((src, os.path.join(self.tmp_dir, 'parallel-%d' % i), options))
+
+        pool = ThreadPool(4)
+        try:
+            counts = converter.convert_many(jobs, executor=pool)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([50 * i for i in range(6)], counts)
+
+        for src, dst, options in jobs:
+            expected = os.path.join(self.tmp_dir, 'sequential')
+            converter.convert(src, expected, options)
+            self.assertEqual(self.read(expected), self.read(dst))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from palm2vcal import database
+
+from tests import samples
+
+
+class SqliteExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+        self.db_path = os.path.join(self.tmp_dir, 'palm.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def load(self, events):
+        samples.write_datebook(self.path, events, next_free=100)
+        export = database.SqliteExport(self.db_path)
+        try:
+            export.load(self.path)
+            rows = export.connection.execute(
+                "SELECT uid, record_id, text, data FROM events ORDER BY text").fetchall()
+        finally:
+            export.close()
+        return export.counts, rows
+
+    def test_reload(self):
+        events = [samples.event(1), samples.event(2)]
+        counts, rows = self.load(events)
+        self.assertEqual(2, counts['inserted'])
+        events[1]['text'] = 'Changed'
+        counts, rows = self.load(events[1:])
+        self.assertEqual({'inserted': 0, 'updated': 1, 'deleted': 1, 'unchanged': 0}, counts)
+        self.assertEqual([u'Changed'], [row[2] for row in rows])
+
+    def test_missing_and_duplicate_ids(self):
+        events = [
+            samples.event(0, text='A'),
+            samples.event(0, text='B'),
+            samples.event(0, text='B'),
+            samples.event(5, text='C'),
+            samples.event(5, text='D'),
+        ]
+        counts, rows = self.load(events)
+        self.assertEqual(5, counts['inserted'])
+        self.assertEqual([u'A', u'B', u'B', u'C', u'D'], [row[2] for row in rows])
+        self.assertEqual(5, len(set(row[0] for row in rows)))
+        self.assertEqual([row[0] for row in rows], [json.loads(row[3])['uid'] for row in rows])
+
+        # Loading the same file again changes nothing
+        counts, rows = self.load(events)
+        self.assertEqual({'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 5}, counts)
+        self.assertEqual(5, len(rows))
+
+    def test_repeated_contents_without_ids(self):
+        events = [samples.event(0, text='A'), samples.event(0, text='B'), samples.event(0, text='A')]
+        counts, rows = self.load(events)
+        self.assertEqual(2, counts['inserted'])
+        self.assertEqual([u'A', u'B'], [row[2] for row in rows])
+        counts, rows = self.load(events)
+        self.assertEqual({'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 2}, counts)
+
+    def test_old_schema(self):
+        import sqlite3
+        connection = sqlite3.connect(self.db_path)
+        connection.execute("CREATE TABLE events (source_id INTEGER, record_id INTEGER)")
+        connection.close()
+        self.assertRaises(ValueError, database.SqliteExport, self.db_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# coding: utf-8
+
+import cStringIO
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import icalendar
+
+from palm2vcal import converter
+from palm2vcal import diff
+from palm2vcal import sync
+
+from tests import samples
+
+
+class SnapshotDiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_path = os.path.join(self.tmp_dir, 'old.dba')
+        self.new_path = os.path.join(self.tmp_dir, 'new.dba')
+        self.state = os.path.join(self.tmp_dir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def diff(self, old_events, new_events, format='json', sync_state=None):
+        samples.write_datebook(self.old_path, old_events, next_free=100)
+        samples.write_datebook(self.new_path, new_events, next_free=100)
+        dst_file = cStringIO.StringIO()
+        with open(self.old_path, 'rb') as old_file:
+            with open(self.new_path, 'rb') as new_file:
+                snapshot_diff = diff.SnapshotDiff(old_file, new_file, sync_state=sync_state)
+                snapshot_diff.export(dst_file, format)
+        return snapshot_diff.counts, dst_file.getvalue()
+
+    def convert(self, events, sync_state=None):
+        samples.write_datebook(self.new_path, events, next_free=100)
+        dst_file = cStringIO.StringIO()
+        with open(self.new_path, 'rb') as src_file:
+            converter.convert(src_file, dst_file, {'sync_state': sync_state})
+        return icalendar.Calendar.from_ical(dst_file.getvalue()).walk('VEVENT')
+
+    def test_changes(self):
+        events = [samples.event(1), samples.event(2), samples.event(3)]
+        counts, data = self.diff(events, [
+            events[0],
+            samples.event(2, text='Changed'),
+            samples.event(4),
+        ])
+        self.assertEqual({'added': 1, 'changed': 1, 'deleted': 1}, counts)
+        changes = dict((change['recordID'], change['action']) for change in json.loads(data))
+        self.assertEqual({2: 'changed', 3: 'deleted', 4: 'added'}, changes)
+
+    def test_identical_snapshots_without_ids(self):
+        events = [
+            samples.event(0, text='Same'),
+            samples.event(0, text='Same'),
+            samples.event(5, text='A'),
+            samples.event(5, text='B'),
+            samples.event(0, text='Same'),
+        ]
+        counts, data = self.diff(events, events)
+        self.assertEqual({'added': 0, 'changed': 0, 'deleted': 0}, counts)
+        self.assertEqual([], json.loads(data))
+
+    def test_cancelled_uids_match_published_ones(self):
+        events = [samples.event(0, text='Same'), samples.event(0, text='Same'), samples.event(1)]
+        published = [str(e['UID']) for e in self.convert(events)]
+        counts, data = self.diff(events, events[1:], format='ics')
+        self.assertEqual({'added': 0, 'changed': 0, 'deleted': 1}, counts)
+        cancelled = icalendar.Calendar.from_ical(data.split('END:VCALENDAR\r\n')[1] + 'END:VCALENDAR\r\n')
+        uids = [str(e['UID']) for e in cancelled.walk('VEVENT')]
+        self.assertEqual(1, len(uids))
+        self.assertIn(uids[0], published)
+
+    def test_sequence_follows_sync_state(self):
+        events = [samples.event(1), samples.event(2), samples.event(3)]
+        self.convert(events, self.state)
+
+        state = sync.SyncState(self.state)
+        state.load()
+        counts, data = self.diff(events, [events[0], samples.event(2, text='Changed')],
+            format='ics', sync_state=state)
+        state.save()
+        sequences = {}
+        for calendar in data.split('END:VCALENDAR\r\n')[:-1]:
+            for e in icalendar.Calendar.from_ical(calendar + 'END:VCALENDAR\r\n').walk('VEVENT'):
+                sequences[unicode(e['SUMMARY'] if 'SUMMARY' in e else e['STATUS'])] = e['SEQUENCE']
+        self.assertEqual({u'Changed': 1, u'CANCELLED': 1}, sequences)
+
+        # A later conversion agrees with the diff
+        events = self.convert([events[0], samples.event(2, text='Changed')], self.state)
+        self.assertEqual({u'Event 1': 0, u'Changed': 1},
+            dict((unicode(e['SUMMARY']), e['SEQUENCE']) for e in events))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+import os
+import time
+import unittest
+
+from palm2vcal import freebusy
+from palm2vcal import occurrences
+
+from tests import samples
+
+
+START = samples.START
+HOUR = samples.HOUR
+MINUTE = 60
+
+
+class FreeBusyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Repeating events keep their local time
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'UTC'
+        time.tzset()
+        self.events = [
+            samples.event(1, START, HOUR),
+            # Overlaps the first one, and touches the third one
+            samples.event(2, START + 30 * MINUTE, 90 * MINUTE),
+            samples.event(3, START + 2 * HOUR, HOUR),
+            samples.event(4, START + 4 * HOUR, HOUR, untimed=True),
+            samples.event(5, START + 5 * HOUR, HOUR),
+            samples.event(6, START + 5 * HOUR + 15 * MINUTE, 30 * MINUTE, repeat=samples.daily()),
+        ]
+        self.busy = freebusy.FreeBusy(occurrences.DatebookQuery([{'datebookList': self.events}]))
+        # Starts within the first event, ends within the sixth one
+        self.start = START + 15 * MINUTE
+        self.end = START + 5 * HOUR + 30 * MINUTE
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def test_busy(self):
+        self.assertEqual([(self.start, START + 3 * HOUR), (START + 5 * HOUR, self.end)],
+            self.busy.busy(self.start, self.end))
+        self.assertEqual([], self.busy.busy(START + 3 * HOUR, START + 4 * HOUR))
+
+        busy = freebusy.FreeBusy(self.busy.query, untimed=True)
+        self.assertEqual([(self.start, START + 3 * HOUR), (START + 4 * HOUR, self.end)],
+            busy.busy(self.start, self.end))
+
+    def test_repeated_occurrences(self):
+        day = samples.DAY
+        self.assertEqual([(START + day + 5 * HOUR + 15 * MINUTE, START + day + 5 * HOUR + 45 * MINUTE)],
+            self.busy.busy(START + day, START + 2 * day))
+
+    def test_overlaps(self):
+        self.assertEqual([
+            ((self.start, START + HOUR, 0), (START + 30 * MINUTE, START + 2 * HOUR, 1)),
+            ((START + 5 * HOUR, self.end, 4), (START + 5 * HOUR + 15 * MINUTE, self.end, 5)),
+        ], self.busy.overlaps(self.start, self.end))
+
+    def test_to_ical(self):
+        text = self.busy.to_ical(self.start, self.end, uid='freebusy-test').to_ical()
+        lines = text.split('\r\n')
+        self.assertIn('BEGIN:VFREEBUSY', lines)
+        self.assertIn('UID:freebusy-test', lines)
+        self.assertIn('DTSTART;VALUE=DATE-TIME:20110313T072140Z', lines)
+        self.assertIn('DTEND;VALUE=DATE-TIME:20110313T123640Z', lines)
+        self.assertEqual([
+            'FREEBUSY:20110313T072140Z/20110313T100640Z',
+            'FREEBUSY:20110313T120640Z/20110313T123640Z',
+        ], [line for line in lines if line.startswith('FREEBUSY')])
+
+
+if __name__ == '__main__':
+    unittest.main()
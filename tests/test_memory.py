@@ -0,0 +1,73 @@
+# coding: utf-8
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from tests import samples
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Fixed bound on the peak memory of a conversion, whatever the number of
+# records; the interpreter and its imports take about 15 MB
+CEILING_KB = 64 * 1024
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PEAK_SCRIPT = """
+import os, resource, sys
+from palm2vcal import converter
+converter.convert(sys.argv[1], os.devnull)
+sys.stdout.write('%d' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+@unittest.skipIf(resource is None, "resource.getrusage() is not available")
+class StreamingMemoryTestCase(unittest.TestCase):
+    """Peak memory of the default, streaming, conversion.
+
+    Each conversion runs in its own interpreter, whose peak resident size
+    is read from getrusage().
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def peak_kb(self, count, record_ids=True):
+        path = os.path.join(self.tmp_dir, 'datebook.dba')
+        samples.write_large_datebook(path, count, record_ids=record_ids)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        peak = int(subprocess.check_output([sys.executable, '-c', PEAK_SCRIPT, path], env=env))
+        if sys.platform == 'darwin':
+            # Bytes instead of kilobytes
+            peak //= 1024
+        return peak
+
+    def test_10k_records(self):
+        self.assertLess(self.peak_kb(10000), CEILING_KB)
+
+    def test_records_without_ids(self):
+        # Each of them gets a UID from its contents
+        peak = self.peak_kb(50000, record_ids=False)
+        self.assertLess(peak, CEILING_KB)
+        self.assertLess(peak, self.peak_kb(5000, record_ids=False) + 4 * 1024)
+
+    @unittest.skipUnless(os.environ.get('PALM2VCAL_LARGE_TESTS'),
+        "takes about 10 minutes; set PALM2VCAL_LARGE_TESTS=1 to run it")
+    def test_1m_records(self):
+        self.assertLess(self.peak_kb(1000000), CEILING_KB)
+
+
+if __name__ == '__main__':
+    unittest.main()
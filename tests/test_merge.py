@@ -0,0 +1,83 @@
+# coding: utf-8
+
+import cStringIO
+import os
+import shutil
+import tempfile
+import unittest
+
+import icalendar
+
+from palm2vcal import merge
+
+from tests import samples
+
+
+class DatebookMergeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, events):
+        path = os.path.join(self.tmp_dir, name)
+        samples.write_datebook(path, events)
+        return path
+
+    def merge(self, paths, **kwargs):
+        src_files = [open(path, 'rb') for path in paths]
+        try:
+            datebook_merge = merge.DatebookMerge(src_files, **kwargs)
+            dst_file = cStringIO.StringIO()
+            datebook_merge.export(dst_file)
+        finally:
+            for src_file in src_files:
+                src_file.close()
+        calendar = icalendar.Calendar.from_ical(dst_file.getvalue())
+        return datebook_merge, calendar.walk('VEVENT')
+
+    def test_merge(self):
+        hour = samples.HOUR
+        first = self.write('a.dba', [samples.event(1, samples.START), samples.event(2, samples.START + 2 * hour)])
+        # Not sorted, and sharing a duplicate with the first file
+        second = self.write('b.dba', [
+            samples.event(7, samples.START + 3 * hour),
+            samples.event(8, samples.START + hour),
+            samples.event(9, samples.START, text='Event 1'),
+        ])
+        datebook_merge, events = self.merge([first, second])
+        self.assertEqual({'events': 4, 'duplicates': 1}, datebook_merge.counts)
+        self.assertEqual([u'Event 1', u'Event 8', u'Event 2', u'Event 7'],
+            [unicode(e['summary']) for e in events])
+
+    def test_long_note(self):
+        note = 'n' * 40000
+        first = self.write('a.dba', [samples.event(1, note=note)])
+        # Unsorted files are indexed by the structural scan
+        second = self.write('b.dba', [
+            samples.event(2, samples.START + samples.DAY, note=note),
+            samples.event(3, samples.START + samples.HOUR),
+        ])
+        datebook_merge, events = self.merge([first, second])
+        self.assertEqual(3, datebook_merge.counts['events'])
+        self.assertEqual([40000, 40000], sorted(len(e['description']) for e in events
+            if 'description' in e))
+
+    def test_external_sort(self):
+        # Shuffled start times, some of them shared
+        starts = [(i * 7) % 11 // 2 for i in range(11)]
+        path = self.write('a.dba', [samples.event(i + 1, samples.START + start * samples.HOUR)
+            for i, start in enumerate(starts)])
+        datebook_merge, in_memory = self.merge([path])
+        for run_size in (1, 3, 11):
+            datebook_merge, events = self.merge([path], run_size=run_size)
+            self.assertEqual(11, datebook_merge.counts['events'])
+            self.assertEqual([unicode(e['summary']) for e in in_memory],
+                [unicode(e['summary']) for e in events])
+            self.assertEqual(sorted(e['dtstart'].dt for e in events), [e['dtstart'].dt for e in events])
+
+
+if __name__ == '__main__':
+    unittest.main()
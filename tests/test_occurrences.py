@@ -0,0 +1,209 @@
+# coding: utf-8
+
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from palm2vcal import occurrences
+from palm2vcal import palmFile
+
+from tests import samples
+
+
+def local_ts(*fields):
+    """Timestamp of a local (year, month, day, hour, minute) time."""
+    return int(time.mktime(fields + (0, 0, 0, -1)))
+
+
+def local_time(ts):
+    return time.localtime(ts)[3:5]
+
+
+def walk(e, start, end):
+    """Occurrences of e between start and end, through getNextRepeatedEvent."""
+    exceptions = set(time.localtime(exc)[:3] for exc in e['repeatEvent']['dateExceptions'])
+    found = []
+    ts = e['startTime']
+    while ts < end and ts <= e['repeatEvent']['endDate']:
+        if ts >= start and time.localtime(ts)[:3] not in exceptions:
+            found.append(ts)
+        next_ts = int(palmFile.getNextRepeatedEvent(
+            {'startTime': ts, 'repeatEvent': e['repeatEvent']})['startTime'])
+        if next_ts <= ts:
+            break
+        ts = next_ts
+    return found
+
+
+class TimeZoneTestCase(unittest.TestCase):
+
+    zone = None
+
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = self.zone
+        time.tzset()
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def occurrences(self, e, start, end):
+        query = occurrences.DatebookQuery([{'datebookList': [e]}])
+        return [o['startTime'] for o in query.occurrences(start, end)]
+
+
+class ExpansionTestCase(TimeZoneTestCase):
+
+    zone = 'UTC'
+
+    def test_same_as_getNextRepeatedEvent(self):
+        year = 366 * samples.DAY
+        cases = [
+            (local_ts(2011, 1, 15, 10, 0), samples.monthly(15)),
+            (local_ts(2011, 1, 28, 10, 0), samples.monthly(28, 5)),
+            # Falls on missing days: stepped as getNextRepeatedEvent does
+            (local_ts(2011, 1, 31, 10, 0), samples.monthly(31)),
+            (local_ts(2011, 3, 1, 10, 0), samples.yearly(2, 1)),
+            (local_ts(2011, 3, 1, 10, 0), samples.yearly(2, 1, 2, local_ts(2020, 1, 1, 0, 0),
+                [local_ts(2015, 3, 1, 0, 0)])),
+            (local_ts(2012, 2, 29, 10, 0), samples.yearly(1, 29)),
+            (local_ts(2011, 1, 3, 10, 0), samples.weekly(2 | 16, local_ts(2011, 6, 1, 0, 0))),
+            (local_ts(2011, 1, 6, 10, 0), samples.weekly(2 | 16)),
+            (local_ts(2011, 1, 6, 10, 0), samples.daily(4, exceptions=[local_ts(2011, 1, 14, 0, 0)])),
+        ]
+        for start, repeat in cases:
+            e = samples.event(1, start, repeat=repeat)
+            for low in (start, start + 200 * samples.DAY, start + 1000 * samples.DAY):
+                self.assertEqual(walk(e, low, low + 3 * year),
+                    self.occurrences(e, low, low + 3 * year), repeat)
+
+
+class QueryTestCase(TimeZoneTestCase):
+
+    zone = 'UTC'
+
+    def setUp(self):
+        TimeZoneTestCase.setUp(self)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        TimeZoneTestCase.tearDown(self)
+
+    def test_bucket_cache(self):
+        week = 7 * samples.DAY
+        start = local_ts(2011, 1, 6, 10, 0)
+        e = samples.event(1, start, repeat=samples.daily())
+        query = occurrences.DatebookQuery([{'datebookList': [e]}], bucket_size=week, cache_size=2)
+        first = start // week * week
+
+        self.assertEqual(7, len(query.occurrences(first + week, first + 2 * week)))
+        self.assertEqual((0, 1), (query.hits, query.misses))
+        self.assertEqual(7, len(query.occurrences(first + week, first + 2 * week)))
+        self.assertEqual((1, 1), (query.hits, query.misses))
+        # Two more buckets evict the first one
+        self.assertEqual(14, len(query.occurrences(first + 2 * week, first + 4 * week)))
+        self.assertEqual((1, 3), (query.hits, query.misses))
+        self.assertEqual(7, len(query.occurrences(first + week, first + 2 * week)))
+        self.assertEqual((1, 4), (query.hits, query.misses))
+        self.assertEqual(2, len(query._cache))
+
+    def test_refresh(self):
+        start = local_ts(2011, 3, 10, 10, 0)
+        samples.write_datebook(self.path, [samples.event(1, start, repeat=samples.daily())])
+        query = occurrences.DatebookQuery.from_file(self.path)
+        day = datetime.date(2011, 3, 15)
+        self.assertEqual(['Event 1'], [o['text'] for o in query.on_day(day)])
+        self.assertFalse(query.refresh())
+        self.assertEqual(['Event 1'], [o['text'] for o in query.on_day(day)])
+        self.assertEqual(1, query.misses)
+
+        samples.write_datebook(self.path, [samples.event(1, start, repeat=samples.daily(),
+            text='Renamed'), samples.event(2, local_ts(2011, 3, 15, 12, 0))])
+        self.assertEqual(['Renamed', 'Event 2'], [o['text'] for o in query.on_day(day)])
+        self.assertEqual(2, query.misses)
+        self.assertFalse(query.refresh())
+
+    def test_on_day_and_week(self):
+        start = local_ts(2011, 3, 10, 10, 0)
+        single = local_ts(2011, 3, 15, 12, 0)
+        query = occurrences.DatebookQuery([{'datebookList': [
+            samples.event(1, single, text='Single'),
+            samples.event(2, start, repeat=samples.daily(), text='Daily'),
+        ]}])
+        found = query.on_day(datetime.date(2011, 3, 15))
+        self.assertEqual([(local_ts(2011, 3, 15, 10, 0), 'Daily'), (single, 'Single')],
+            [(o['startTime'], o['text']) for o in found])
+        self.assertEqual(found[0]['endTime'], found[0]['startTime'] + samples.HOUR)
+
+        found = query.on_week(datetime.date(2011, 3, 16))
+        self.assertEqual(8, len(found))
+        self.assertEqual(local_ts(2011, 3, 14, 10, 0), found[0]['startTime'])
+        self.assertEqual(local_ts(2011, 3, 20, 10, 0), found[-1]['startTime'])
+
+
+class DaylightSavingTestCase(TimeZoneTestCase):
+    """Occurrences across the DST changes of 2011 in Paris: 02:00 on
+    March 27th went to 03:00, 03:00 on October 30th back to 02:00."""
+
+    zone = 'Europe/Paris'
+
+    def test_same_as_getNextRepeatedEvent(self):
+        repeats = [samples.daily(), samples.daily(3), samples.weekly(1 | 2 | 64)]
+        for month, day in ((3, 20), (10, 23)):
+            for hour, minute in ((0, 30), (10, 0), (23, 30)):
+                for repeat in repeats:
+                    start = local_ts(2011, month, day, hour, minute)
+                    e = samples.event(1, start, repeat=repeat)
+                    found = self.occurrences(e, start, start + 21 * samples.DAY)
+                    self.assertEqual(walk(e, start, start + 21 * samples.DAY), found)
+                    self.assertEqual(set([(hour, minute)]), set(map(local_time, found)))
+
+    def test_skipped_local_time(self):
+        # 02:30 did not exist on March 27th: that occurrence is moved an
+        # hour later, and the next ones stay at 02:30. getNextRepeatedEvent
+        # moves it an hour earlier instead, and keeps every later
+        # occurrence at 01:30: the two differ from that day on.
+        start = local_ts(2011, 3, 25, 2, 30)
+        e = samples.event(1, start, repeat=samples.daily())
+        end = local_ts(2011, 3, 28, 12, 0)
+        found = self.occurrences(e, start, end)
+        self.assertEqual([(2, 30), (2, 30), (3, 30), (2, 30)], map(local_time, found))
+        self.assertEqual([(2, 30), (2, 30), (1, 30), (1, 30)],
+            map(local_time, walk(e, start, end)))
+
+    def test_late_weekly_event(self):
+        # On Mondays and Wednesdays at 23:30: getNextRepeatedEvent steps
+        # a day at a time, and lands on Monday 00:30 from Saturday 23:30,
+        # an hour short of a day; moving back to 23:30 then keeps Sunday.
+        start = local_ts(2011, 3, 23, 23, 30)
+        e = samples.event(1, start, repeat=samples.weekly(2 | 8))
+        end = local_ts(2011, 3, 29, 12, 0)
+        self.assertEqual([start, local_ts(2011, 3, 28, 23, 30)],
+            self.occurrences(e, start, end))
+        self.assertEqual([start, local_ts(2011, 3, 27, 23, 30), local_ts(2011, 3, 28, 23, 30)],
+            walk(e, start, end))
+
+    def test_monthly_and_yearly_events(self):
+        # getNextRepeatedEvent moves these an hour later at each step
+        # between two dates in summer time
+        start = local_ts(2011, 7, 1, 10, 0)
+        end = local_ts(2014, 1, 1, 0, 0)
+        for repeat, count in ((samples.monthly(1), 30), (samples.yearly(6, 1), 3)):
+            e = samples.event(1, start, repeat=repeat)
+            found = self.occurrences(e, start, end)
+            self.assertEqual(count, len(found))
+            self.assertEqual(set([(10, 0)]), set(map(local_time, found)))
+        self.assertEqual([(10, 0), (11, 0), (12, 0)], map(local_time, walk(e, start, end)))
+
+
+if __name__ == '__main__':
+    unittest.main()
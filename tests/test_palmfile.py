@@ -0,0 +1,141 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from palm2vcal import palmFile
+
+from tests import samples
+
+
+class ValidationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_valid(self):
+        samples.write_datebook(self.path, [samples.event(1), samples.event(2)])
+        summary = palmFile.validatePalmFile(self.path)
+        self.assertEqual(2, summary['numRecords'])
+        self.assertEqual(os.path.getsize(self.path), summary['size'])
+
+    def test_long_strings(self):
+        # Lengths are 16-bit values: up to 65535 bytes
+        samples.write_datebook(self.path, [
+            samples.event(1, note='n' * 40000),
+            samples.event(2, text='t' * 0xFFFF),
+        ])
+        self.assertEqual(2, palmFile.validatePalmFile(self.path)['numRecords'])
+        events = palmFile.getEvents(palmFile.readPalmFile(self.path))
+        self.assertEqual(40000, len(events[0]['note']))
+
+    def test_many_exceptions(self):
+        exceptions = [samples.START + i * samples.DAY for i in xrange(2000)]
+        samples.write_datebook(self.path, [
+            samples.event(1, repeat=samples.daily(exceptions=exceptions))])
+        self.assertEqual(1, palmFile.validatePalmFile(self.path)['numRecords'])
+
+    def test_truncated(self):
+        samples.write_datebook(self.path, [samples.event(1, note='n' * 1000)])
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-600])
+        with self.assertRaises(palmFile.PalmFileError) as context:
+            palmFile.validatePalmFile(self.path)
+        self.assertEqual(0, context.exception.record)
+
+
+class UpdateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+        self.events = [samples.event(1, note='first'), samples.event(2), samples.event(3)]
+        samples.write_datebook(self.path, self.events)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        header = palmFile.readPalmFile(self.path)[0]
+        self.assertEqual(len(header['datebookList']) * len(samples.DATEBOOK_SCHEMA),
+            header['numEntries'])
+        return header
+
+    def test_same_size_edit(self):
+        size = os.path.getsize(self.path)
+        inode = os.stat(self.path).st_ino
+        changed = dict(self.events[1], text='Event X')
+        self.assertEqual(3, palmFile.updatePalmFile(self.path, {2: changed}))
+        # Written in place
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+        self.assertEqual(size, os.path.getsize(self.path))
+        header = self.read()
+        self.assertEqual(['Event 1', 'Event X', 'Event 3'],
+            [e['text'] for e in header['datebookList']])
+        self.assertEqual(4, header['nextFree'])
+
+    def test_resize(self):
+        changed = dict(self.events[0], note='a much longer note ' * 100)
+        os.chmod(self.path, 0640)
+        self.assertEqual(3, palmFile.updatePalmFile(self.path, {1: changed}))
+        header = self.read()
+        self.assertEqual(changed['note'], header['datebookList'][0]['note'])
+        self.assertEqual(['Event 1', 'Event 2', 'Event 3'],
+            [e['text'] for e in header['datebookList']])
+        self.assertEqual(4, header['nextFree'])
+        self.assertEqual(0640, os.stat(self.path).st_mode & 07777)
+        self.assertEqual(['datebook.dba'], os.listdir(self.tmp_dir))
+
+    def test_append(self):
+        self.assertEqual(4, palmFile.updatePalmFile(self.path,
+            additions=[samples.event(7, text='Added')]))
+        header = self.read()
+        self.assertEqual(['Event 1', 'Event 2', 'Event 3', 'Added'],
+            [e['text'] for e in header['datebookList']])
+        self.assertEqual(8, header['nextFree'])
+
+    def test_atomic_edit_and_append(self):
+        inode = os.stat(self.path).st_ino
+        palmFile.updatePalmFile(self.path, {3: dict(self.events[2], text='Event Z')},
+            [samples.event(4)], atomic=True)
+        self.assertNotEqual(inode, os.stat(self.path).st_ino)
+        header = self.read()
+        self.assertEqual(['Event 1', 'Event 2', 'Event Z', 'Event 4'],
+            [e['text'] for e in header['datebookList']])
+        self.assertEqual(5, header['nextFree'])
+
+    def test_existing_tmp_file_kept(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write('keep me')
+        palmFile.updatePalmFile(self.path, additions=[samples.event(4)], atomic=True)
+        with open(tmp_path, 'rb') as f:
+            self.assertEqual('keep me', f.read())
+        self.assertEqual(4, len(self.read()['datebookList']))
+
+    def test_unknown_record(self):
+        with self.assertRaises(KeyError):
+            palmFile.updatePalmFile(self.path, {9: samples.event(9)})
+        self.assertEqual(3, len(self.read()['datebookList']))
+
+    def test_appointments(self):
+        event = dict(samples.event(None, text='New'), position=4)
+        event = palmFile.createAppointment(self.path, event)
+        self.assertEqual(4, event['recordID'])
+        palmFile.changeAppointment(self.path, dict(event, text='Renamed'))
+        header = self.read()
+        self.assertEqual(['Event 1', 'Event 2', 'Event 3', 'Renamed'],
+            [e['text'] for e in header['datebookList']])
+        self.assertEqual(5, header['nextFree'])
+
+
+if __name__ == '__main__':
+    unittest.main()
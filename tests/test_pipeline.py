@@ -0,0 +1,122 @@
+# coding: utf-8
+
+import cStringIO
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import icalendar
+
+from palm2vcal import converter
+from palm2vcal import pipeline
+
+from tests import samples
+
+
+class FanOutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+        # Records without an ID, two of them alike
+        samples.write_datebook(self.path, [
+            samples.event(0, text='Same'),
+            samples.event(0, text='Same'),
+            samples.event(0, text='Other', category=1),
+        ], next_free=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def ics_uids(self, data):
+        return [str(e['UID']) for e in icalendar.Calendar.from_ical(data).walk('VEVENT')]
+
+    def jsonl_uids(self, data):
+        return [json.loads(line)['uid'] for line in data.splitlines()]
+
+    def convert(self, output_format):
+        dst_file = cStringIO.StringIO()
+        with open(self.path, 'rb') as src_file:
+            converter.convert(src_file, dst_file, {'output_format': output_format})
+        return dst_file.getvalue()
+
+    def read(self, *names):
+        with open(os.path.join(self.tmp_dir, *names), 'rb') as f:
+            return f.read()
+
+    def test_uids_match_standalone_conversions(self):
+        with open(self.path, 'rb') as src_file:
+            conv = converter.Palm2vCalConverter(src_file, streaming=True)
+            fan = pipeline.FanOut(conv)
+            for spec in ('ics:%s' % os.path.join(self.tmp_dir, 'out.ics'),
+                    'jsonl:%s' % os.path.join(self.tmp_dir, 'out.jsonl'),
+                    'category:%s' % os.path.join(self.tmp_dir, 'categories')):
+                fan.add_sink(spec, pipeline.make_sink(conv, spec))
+            self.assertEqual({}, fan.run())
+
+        uids = self.ics_uids(self.convert('ics'))
+        self.assertEqual(3, len(set(uids)))
+        self.assertEqual(uids, self.ics_uids(self.read('out.ics')))
+        self.assertEqual(uids, self.jsonl_uids(self.convert('jsonl')))
+        self.assertEqual(uids, self.jsonl_uids(self.read('out.jsonl')))
+        self.assertEqual(uids[:2], self.ics_uids(self.read('categories', 'Unfiled-0.ics')))
+        self.assertEqual(uids[2:], self.ics_uids(self.read('categories', 'Work-1.ics')))
+
+    def test_sync_state(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        state = os.path.join(self.tmp_dir, 'state.json')
+        output = os.path.join(self.tmp_dir, 'out.ics')
+        sequences = []
+        for text in ('Other', 'Changed'):
+            samples.write_datebook(self.path, [samples.event(1), samples.event(2, text=text)])
+            subprocess.check_call([sys.executable, os.path.join(root, 'bin', 'palm2vcal'),
+                '--sync-state', state, '--tee', 'ics:' + output, '--tee', 'stats:' + output + '.json',
+                self.path], env=dict(os.environ, PYTHONPATH=root))
+            events = icalendar.Calendar.from_ical(self.read('out.ics')).walk('VEVENT')
+            sequences.append(dict((unicode(e['SUMMARY']), e['SEQUENCE']) for e in events))
+        self.assertEqual([{u'Event 1': 0, u'Other': 0}, {u'Event 1': 0, u'Changed': 1}], sequences)
+        self.assertTrue(os.path.exists(state))
+
+    def test_parse_sink(self):
+        self.assertEqual(('jsonl', 'out.jsonl'), pipeline.parse_sink('jsonl:out.jsonl'))
+        for spec in ('out.ics', 'ics:', 'pdf:out.pdf'):
+            self.assertRaises(ValueError, pipeline.parse_sink, spec)
+
+
+class PipelinedConversionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+        self.state = os.path.join(self.tmp_dir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def convert(self, *args):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen([sys.executable, os.path.join(root, 'bin', 'palm2vcal')] +
+            list(args) + [self.path], stdout=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=root))
+        out, err = process.communicate()
+        self.assertEqual(0, process.returncode)
+        events = icalendar.Calendar.from_ical(out).walk('VEVENT')
+        return dict((unicode(e['SUMMARY']), e['SEQUENCE']) for e in events)
+
+    def test_sync_state(self):
+        samples.write_datebook(self.path, [samples.event(1), samples.event(2)])
+        self.assertEqual({u'Event 1': 0, u'Event 2': 0},
+            self.convert('--pipelined', '--sync-state', self.state))
+        samples.write_datebook(self.path, [samples.event(1), samples.event(2, text='Changed')])
+        self.assertEqual({u'Event 1': 0, u'Changed': 1},
+            self.convert('--pipelined', '--sync-state', self.state))
+        # Same state as plain conversions
+        self.assertEqual({u'Event 1': 0, u'Changed': 1},
+            self.convert('--sync-state', self.state))
+
+
+if __name__ == '__main__':
+    unittest.main()
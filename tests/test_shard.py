@@ -0,0 +1,89 @@
+# coding: utf-8
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import icalendar
+
+from palm2vcal import shard
+
+from tests import samples
+
+
+YEAR = 365 * samples.DAY
+
+
+class ShardedExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'datebook.dba')
+        self.dst_dir = os.path.join(self.tmp_dir, 'shards')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def export(self, events, **kwargs):
+        samples.write_datebook(self.path, events)
+        export = shard.ShardedExport(self.path, self.dst_dir, **kwargs)
+        export.export()
+        return export
+
+    def manifest(self):
+        with open(os.path.join(self.dst_dir, shard.MANIFEST_NAME), 'rb') as f:
+            return json.load(f)
+
+    def summaries(self, key):
+        name = self.manifest()['shards'][key]['file']
+        with open(os.path.join(self.dst_dir, name), 'rb') as f:
+            calendar = icalendar.Calendar.from_ical(f.read())
+        return sorted(unicode(e['SUMMARY']) for e in calendar.walk('VEVENT'))
+
+    def test_unchanged_changed_and_removed_shards(self):
+        events = [samples.event(1), samples.event(2, samples.START + YEAR),
+            samples.event(3, samples.START + 2 * YEAR)]
+        export = self.export(events)
+        self.assertEqual([u'2011', u'2012', u'2013'], export.written)
+        self.assertEqual([u'Event 2'], self.summaries(u'2012'))
+
+        export = self.export([events[0], samples.event(2, samples.START + YEAR, text='Changed')])
+        self.assertEqual([u'2012'], export.written)
+        self.assertEqual([u'2011'], export.skipped)
+        self.assertEqual([u'2013'], export.removed)
+        self.assertEqual([u'Changed'], self.summaries(u'2012'))
+        self.assertEqual(['2011.ics', '2012.ics', shard.MANIFEST_NAME],
+            sorted(os.listdir(self.dst_dir)))
+
+    def test_option_change_rebuilds_shards(self):
+        events = [samples.event(1), samples.event(2, samples.START + YEAR)]
+        self.export(events)
+        export = self.export(events, shard_by='count', shard_size=1)
+        self.assertEqual([u'00000', u'00001'], export.written)
+        self.assertEqual([], export.skipped)
+        self.assertEqual(['00000.ics', '00001.ics', shard.MANIFEST_NAME],
+            sorted(os.listdir(self.dst_dir)))
+        self.assertEqual('count', self.manifest()['options']['shard_by'])
+
+    def test_temporary_files(self):
+        os.makedirs(self.dst_dir)
+        # Not a temporary file of ours
+        with open(os.path.join(self.dst_dir, '2011.ics.tmp'), 'wb') as f:
+            f.write('keep')
+        umask = os.umask(022)
+        try:
+            self.export([samples.event(1)])
+        finally:
+            os.umask(umask)
+        with open(os.path.join(self.dst_dir, '2011.ics.tmp'), 'rb') as f:
+            self.assertEqual('keep', f.read())
+        self.assertEqual(['2011.ics', '2011.ics.tmp', shard.MANIFEST_NAME],
+            sorted(os.listdir(self.dst_dir)))
+        self.assertEqual(0644, stat.S_IMODE(os.stat(os.path.join(self.dst_dir, '2011.ics')).st_mode))
+
+
+if __name__ == '__main__':
+    unittest.main()
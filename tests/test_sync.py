@@ -0,0 +1,46 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from palm2vcal import sync
+
+
+class SyncStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        state = sync.SyncState(self.path, now=1000)
+        self.assertEqual(0, state.update('a', 'digest')[0])
+        state.save()
+
+        state = sync.SyncState(self.path, now=2000)
+        state.load()
+        self.assertEqual(0, state.update('a', 'digest')[0])
+        sequence, last_modified = state.update('a', 'other')
+        self.assertEqual(1, sequence)
+
+    def test_missing(self):
+        state = sync.SyncState(self.path)
+        state.load()
+        self.assertEqual({}, state.entries)
+
+    def test_corrupt(self):
+        for contents in ('{"a": ["digest", 0, 10', '["a"]', '{"a": 3}'):
+            with open(self.path, 'wb') as f:
+                f.write(contents)
+            with self.assertRaises(sync.SyncStateError) as context:
+                sync.SyncState(self.path).load()
+            self.assertIn(self.path, str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# coding: utf-8
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from palm2vcal import watch
+
+from tests import samples
+
+
+class DirectoryWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.dst_dir = os.path.join(self.tmp_dir, 'dst')
+        os.mkdir(self.src_dir)
+        os.mkdir(self.dst_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.src_dir, name)
+        samples.write_datebook(path, [samples.event(1, text=text)])
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.dst_dir, name), 'rb') as f:
+            return f.read()
+
+    def test_outputs_keep_source_names(self):
+        self.write('a.dba', 'From dba')
+        self.write('a.dat', 'From dat')
+        path = self.write('a.dba.gz', 'From gz')
+        with open(path, 'rb') as f:
+            data = f.read()
+        with gzip.open(path, 'wb') as f:
+            f.write(data)
+
+        watcher = watch.DirectoryWatcher(self.src_dir, self.dst_dir, settle=0)
+        converted, removed = watcher.poll(now=samples.START * 2)
+        self.assertEqual(['a.dat', 'a.dba', 'a.dba.gz'], converted)
+        self.assertIn('From dba', self.read('a.dba.ics'))
+        self.assertIn('From dat', self.read('a.dat.ics'))
+        self.assertIn('From gz', self.read('a.dba.gz.ics'))
+
+        os.remove(os.path.join(self.src_dir, 'a.dat'))
+        converted, removed = watcher.poll(now=samples.START * 2)
+        self.assertEqual(['a.dat'], removed)
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'a.dat.ics')))
+        self.assertIn('From dba', self.read('a.dba.ics'))
+
+
+if __name__ == '__main__':
+    unittest.main()